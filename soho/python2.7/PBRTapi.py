@@ -1,8 +1,12 @@
 from __future__ import print_function, division, absolute_import
+import sys
 from contextlib import contextmanager
+from StringIO import StringIO
 
 import soho
 
+import PBRTstate
+
 PBRT_COMMENT = "#"
 
 
@@ -161,13 +165,20 @@ def AttributeEnd():
 
 
 def ObjectBegin(name):
+    PBRTstate.scene_state.object_depth += 1
     soho.indent(1, 'ObjectBegin "%s"' % name, PBRT_COMMENT)
 
 
 def ObjectEnd():
+    PBRTstate.scene_state.object_depth -= 1
     soho.indent(-1, "ObjectEnd", PBRT_COMMENT)
 
 
+def in_object_definition():
+    """Whether the api calls are currently within an ObjectBegin/ObjectEnd"""
+    return PBRTstate.scene_state.object_depth > 0
+
+
 def ObjectInstance(name):
     _api_call_with_args("ObjectInstance", name)
 
@@ -245,11 +256,24 @@ def TransformBlock():
 @contextmanager
 def ObjectBlock(name):
     ObjectBegin(name)
-    yield
-    ObjectEnd()
+    try:
+        yield
+    finally:
+        ObjectEnd()
 
 
 # Helper context
 @contextmanager
 def NullBlock():
     yield
+
+
+@contextmanager
+def CaptureBlock():
+    """Redirects the output of api calls into a StringIO which is yielded"""
+    stdout = sys.stdout
+    sys.stdout = output = StringIO()
+    try:
+        yield output
+    finally:
+        sys.stdout = stdout
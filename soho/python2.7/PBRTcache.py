@@ -0,0 +1,176 @@
+from __future__ import print_function, division, absolute_import
+
+import os
+import sys
+import array
+import struct
+import hashlib
+import tempfile
+import collections
+
+import hou
+
+# Geometry which is expensive to generate, such as pre-diced subdivision
+# surfaces, is cached here. Unlike the PBRTState this is not reset between
+# renders so repeated exports of unchanged geometry within a session can
+# skip the work entirely.
+MAX_CACHED_GEOS = 32
+_geo_cache = collections.OrderedDict()
+
+# mkstemp creates files only readable by their owner, so written files are
+# given the permissions open() would have created them with. The umask can
+# only be read by setting it, which is done once as it is process wide.
+_umask = os.umask(0)
+os.umask(_umask)
+
+
+def geo_hash(gdp, *extra):
+    """Returns a hex digest uniquely identifying the geometry
+
+    Args:
+        gdp (hou.Geometry): Input geo
+        extra: Any additional values which affect how the geometry is
+               processed, for example a subdivision level.
+    Returns: str
+    """
+    sha = hashlib.sha1(gdp.data())
+    for value in extra:
+        sha.update(repr(value))
+    return sha.hexdigest()
+
+
+def sop_key(node, *extra):
+    """Returns a key identifying a SOP's cooked geometry without hashing it
+
+    A node's cook count changes whenever its geometry may have changed and
+    its session id tells it apart from nodes later created at the same path,
+    so unlike geo_hash the geometry's data is never serialized.
+
+    Args:
+        node (hou.SopNode): SOP whose geometry has been cooked
+        extra: Any additional values which affect how the geometry is
+               processed, for example which part of it is used.
+    Returns: tuple
+    """
+    return (node.path(), node.sessionId(), node.cookCount()) + extra
+
+
+def file_key(filename, *extra):
+    """Returns a hex digest identifying a file by its path, mtime and size
+
+    Args:
+        filename (str): Path to an existing file
+        extra: Any additional values which affect how the file is processed
+    Returns: str
+    """
+    stat = os.stat(filename)
+    sha = hashlib.sha1(os.path.abspath(filename))
+    sha.update(repr((stat.st_mtime, stat.st_size) + extra))
+    return sha.hexdigest()
+
+
+def get_cached_geo(key):
+    """Returns a copy of the cached geometry or None if not cached"""
+    gdp = _geo_cache.pop(key, None)
+    if gdp is None:
+        return None
+    # Reinsert to mark it as the most recently used.
+    _geo_cache[key] = gdp
+    # Callers are free to modify the returned geometry (the trianglemesh
+    # wrangler runs verbs on it) so return a copy.
+    copy_gdp = hou.Geometry()
+    copy_gdp.merge(gdp)
+    return copy_gdp
+
+
+def cache_geo(key, gdp):
+    """Stores a frozen copy of the geometry in the cache"""
+    _geo_cache.pop(key, None)
+    _geo_cache[key] = gdp.freeze()
+    while len(_geo_cache) > MAX_CACHED_GEOS:
+        _geo_cache.popitem(last=False)
+
+
+def clear_geo_cache():
+    _geo_cache.clear()
+
+
+def cache_filename(cache_dir, key, ext="ply"):
+    """Returns a path within the cache_dir for the key, creating the dir"""
+    cache_dir = hou.expandString(cache_dir)
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    return os.path.join(cache_dir, "%s.%s" % (key, ext))
+
+
+def write_ply(filename, P, indices, N=None, uv=None):
+    """Writes a binary PLY file of triangles readable by pbrt's plymesh
+
+    Args:
+        filename (str): Output file
+        P (array.array): Flat array of point positions
+        indices (array.array): Flat array of triangle point indices
+        N (array.array): Flat array of point normals (Optional)
+        uv (array.array): Flat array of point uvs, with either 2 or
+                          3 components per point. (Optional)
+    Returns: None
+    """
+    num_pts = len(P) // 3
+    num_faces = len(indices) // 3
+
+    columns = [(P, 3, ("x", "y", "z"))]
+    if N is not None:
+        columns.append((N, 3, ("nx", "ny", "nz")))
+    if uv is not None:
+        # Houdini uvs are generally 3 floats while pbrt only wants u and v
+        columns.append((uv, len(uv) // num_pts if num_pts else 2, ("u", "v")))
+
+    header = [
+        "ply",
+        "format binary_little_endian 1.0",
+        "element vertex %i" % num_pts,
+    ]
+    num_columns = sum(len(names) for values, size, names in columns)
+    vertex_data = array.array("f", [0.0]) * (num_pts * num_columns)
+    column = 0
+    for values, size, names in columns:
+        for i, name in enumerate(names):
+            header.append("property float %s" % name)
+            vertex_data[column::num_columns] = array.array("f", values[i::size])
+            column += 1
+    header.append("element face %i" % num_faces)
+    header.append("property list uchar int vertex_indices")
+    header.append("end_header")
+
+    if sys.byteorder != "little":
+        vertex_data.byteswap()
+
+    # The face vertex count is a uchar so each face is packed as a uchar
+    # followed by 3 ints instead of writing an array directly.
+    face_struct = struct.Struct("<B3i")
+    face_bytes = b"".join(
+        face_struct.pack(3, indices[i], indices[i + 1], indices[i + 2])
+        for i in xrange(0, len(indices), 3)
+    )
+
+    # Concurrent renders may share a cache dir, so the file is written under
+    # a temporary name and renamed into place once complete.
+    fd, tmp_filename = tempfile.mkstemp(
+        suffix=".tmp",
+        prefix=os.path.basename(filename),
+        dir=os.path.dirname(filename) or os.curdir,
+    )
+    try:
+        with os.fdopen(fd, "wb") as ply_file:
+            ply_file.write("\n".join(header) + "\n")
+            vertex_data.tofile(ply_file)
+            ply_file.write(face_bytes)
+        os.chmod(tmp_filename, 0o666 & ~_umask)
+        os.rename(tmp_filename, filename)
+    except (IOError, OSError):
+        os.remove(tmp_filename)
+        # Windows won't rename over an existing file, in which case another
+        # render has already written the same file.
+        if not os.path.exists(filename):
+            raise
+    return
@@ -1,6 +1,7 @@
 from __future__ import print_function, division, absolute_import
 
 import os
+import math
 import array
 import itertools
 import collections
@@ -8,6 +9,7 @@ import collections
 import hou
 
 import PBRTapi as api
+import PBRTcache
 from PBRTnodes import BaseNode, MaterialNode, PBRTParam, ParamSet
 from PBRTstate import scene_state, HVER_17_5, HVER_18
 
@@ -76,6 +78,141 @@ def linear_vtx_gen(gdp):
     return range(len(gdp.iterPrims()) * 3)
 
 
+def weld_vertices(indices, attribs, tolerance=0.0):
+    """Merge points which have identical attribute tuples
+
+    Each point's values across all the attribs are combined into a single
+    tuple which is then hashed. Points with matching tuples are merged into
+    one and the indices are remapped to the merged points. If a tolerance
+    is given the values are quantized to it before hashing.
+
+    Args:
+        indices (iterable): Point indices of the triangles
+        attribs (list of array.array): Flat per point float arrays, each of
+                                       which must be 3 floats per point
+        tolerance (float): Quantization step, 0 for exact matches
+                           (Optional, defaults to 0)
+    Returns:
+        tuple of the remapped indices and a list of the welded attribs,
+        both as array.arrays
+    """
+
+    # Split each attribute into its components so the per point tuples
+    # can be built with a single zip instead of slicing per point.
+    columns = []
+    for attrib in attribs:
+        columns.extend((attrib[0::3], attrib[1::3], attrib[2::3]))
+
+    if tolerance > 0.0:
+        inv_tolerance = 1.0 / tolerance
+        columns = [[int(round(x * inv_tolerance)) for x in c] for c in columns]
+
+    # pt_map maps the original point number to the welded one while
+    # kept_pts holds the original point number of each welded point.
+    welded = {}
+    pt_map = array.array("i")
+    kept_pts = array.array("i")
+    for pt, key in enumerate(itertools.izip(*columns)):
+        welded_pt = welded.get(key)
+        if welded_pt is None:
+            welded_pt = len(kept_pts)
+            welded[key] = welded_pt
+            kept_pts.append(pt)
+        pt_map.append(welded_pt)
+
+    welded_indices = array.array("i", (pt_map[i] for i in indices))
+    welded_attribs = []
+    for attrib in attribs:
+        welded_attrib = array.array("f")
+        for pt in kept_pts:
+            i = pt * 3
+            welded_attrib.extend((attrib[i], attrib[i + 1], attrib[i + 2]))
+        welded_attribs.append(welded_attrib)
+    return welded_indices, welded_attribs
+
+
+def _morton_spread(x):
+    """Spread the lower 10 bits of x so there are two 0 bits between each"""
+    x &= 0x3FF
+    x = (x | (x << 16)) & 0x030000FF
+    x = (x | (x << 8)) & 0x0300F00F
+    x = (x | (x << 4)) & 0x030C30C3
+    x = (x | (x << 2)) & 0x09249249
+    return x
+
+
+def spatial_reorder(indices, attribs, prim_attribs=()):
+    """Reorder triangles and points so they are coherent in space
+
+    Triangles are sorted by the Morton code of their centroids, then the
+    points are renumbered in the order they are first referenced by the
+    sorted triangles. Points which are not referenced are dropped.
+
+    Args:
+        indices (iterable): Point indices of the triangles
+        attribs (list of array.array): Flat per point float arrays, each of
+                                       which must be 3 floats per point.
+                                       The first must be P.
+        prim_attribs (list of array.array): Per triangle arrays with one
+                                            value per triangle (Optional)
+    Returns:
+        tuple of the reordered indices, attribs and prim_attribs
+    """
+    indices = array.array("i", indices)
+    P = attribs[0]
+    num_tris = len(indices) // 3
+
+    centroids = []
+    for tri in xrange(num_tris):
+        a, b, c = indices[tri * 3], indices[tri * 3 + 1], indices[tri * 3 + 2]
+        centroids.append(
+            (
+                P[a * 3] + P[b * 3] + P[c * 3],
+                P[a * 3 + 1] + P[b * 3 + 1] + P[c * 3 + 1],
+                P[a * 3 + 2] + P[b * 3 + 2] + P[c * 3 + 2],
+            )
+        )
+
+    # Quantize the centroids to 10 bits per axis within their bounds
+    axes = zip(*centroids) if centroids else ((), (), ())
+    lows = [min(axis) if axis else 0.0 for axis in axes]
+    highs = [max(axis) if axis else 0.0 for axis in axes]
+    scales = [1023.0 / (hi - lo) if hi > lo else 0.0 for lo, hi in zip(lows, highs)]
+
+    def morton(centroid):
+        x, y, z = (int((v - lo) * s) for v, lo, s in zip(centroid, lows, scales))
+        return _morton_spread(x) | (_morton_spread(y) << 1) | (_morton_spread(z) << 2)
+
+    tri_order = sorted(xrange(num_tris), key=lambda tri: morton(centroids[tri]))
+
+    pt_map = {}
+    kept_pts = array.array("i")
+    reordered_indices = array.array("i")
+    for tri in tri_order:
+        i = tri * 3
+        for pt in (indices[i], indices[i + 1], indices[i + 2]):
+            new_pt = pt_map.get(pt)
+            if new_pt is None:
+                new_pt = len(kept_pts)
+                pt_map[pt] = new_pt
+                kept_pts.append(pt)
+            reordered_indices.append(new_pt)
+
+    reordered_attribs = []
+    for attrib in attribs:
+        reordered_attrib = array.array("f")
+        for pt in kept_pts:
+            i = pt * 3
+            reordered_attrib.extend((attrib[i], attrib[i + 1], attrib[i + 2]))
+        reordered_attribs.append(reordered_attrib)
+
+    reordered_prim_attribs = [
+        array.array(prim_attrib.typecode, (prim_attrib[tri] for tri in tri_order))
+        for prim_attrib in prim_attribs
+    ]
+    return reordered_indices, reordered_attribs, reordered_prim_attribs
+
+
 def prim_transform(prim):
     """Return a tuple representing the Matrix4 of the transform intrinsic"""
     rot_mat = hou.Matrix3(prim.intrinsicValue("transform"))
@@ -144,22 +281,41 @@ def disk_wrangler(gdp, paramset=None, properties=None, override_node=None):
 def packeddisk_wrangler(gdp, paramset=None, properties=None, override_node=None):
     """Outputs "ply" Shapes for the input geometry
 
+    Packed disk files which are not PLYs are converted and cached if the
+    pbrt_packedcachedir property is set, otherwise they are skipped.
+
     Args:
         gdp (hou.Geometry): Input geo
         paramset (ParamSet): Any base params to add to the shape. (Optional)
         properties (dict): Dictionary of SohoParms (Optional)
     Returns: None
     """
+    if properties is None:
+        properties = {}
+
+    computeN = True
+    if "pbrt_computeN" in properties:
+        computeN = properties["pbrt_computeN"].Value[0]
+    cache_dir = None
+    if "packedcachedir" in properties:
+        cache_dir = properties["packedcachedir"].Value[0]
+
     alpha_paramset = mesh_alpha_texs(properties)
+    ply_filenames = {}
     for prim in gdp.prims():
         shape_paramset = ParamSet(paramset)
         shape_paramset |= prim_override(prim, override_node)
         filename = prim.intrinsicValue("filename")
         if not filename:
             continue
-        if os.path.splitext(filename)[1].lower() != ".ply":
+        # Many prims can share a file, so each is only looked up once
+        if filename not in ply_filenames:
+            ply_filenames[filename] = packeddisk_ply(filename, computeN, cache_dir)
+            if ply_filenames[filename] is None:
+                api.Comment("Skipping %s, it can not be loaded as a PLY" % filename)
+        if ply_filenames[filename] is None:
             continue
-        shape_paramset.replace(PBRTParam("string", "filename", filename))
+        shape_paramset.replace(PBRTParam("string", "filename", ply_filenames[filename]))
         shape_paramset.update(alpha_paramset)
         with api.TransformBlock():
             xform = prim_transform(prim)
@@ -168,6 +324,196 @@ def packeddisk_wrangler(gdp, paramset=None, properties=None, override_node=None)
     return
 
 
+# Intrinsics which identify the shared geometry of a packed primitive. Prims
+# of other types, or missing these intrinsics, are unpacked in place.
+PACKED_IDENTITY_INTRINSICS = {
+    "PackedGeometry": ("geometryid",),
+    "PackedFragment": ("geometryid", "fragmentattribute", "fragmentname"),
+    "AlembicRef": ("abcfilename", "abcobjectpath", "abcframe"),
+}
+
+
+def packed_identity(prim):
+    """Returns a tuple identifying a packed prim's geometry or None if unknown"""
+    typename = prim.intrinsicValue("typename")
+    intrinsics = PACKED_IDENTITY_INTRINSICS.get(typename)
+    if intrinsics is None:
+        return None
+    names = prim.intrinsicNames()
+    if any(x not in names for x in intrinsics):
+        return None
+    return (typename,) + tuple(prim.intrinsicValue(x) for x in intrinsics)
+
+
+def _unpack(gdp):
+    """Unpacks all packed primitives, including nested ones, of the geometry"""
+    unpack_verb = hou.sopNodeTypeCategory().nodeVerb("unpack")
+    while any(isinstance(prim, hou.PackedPrim) for prim in gdp.iterPrims()):
+        unpacked_gdp = hou.Geometry()
+        unpack_verb.execute(unpacked_gdp, [gdp])
+        gdp = unpacked_gdp
+    return gdp
+
+
+def _prim_subset(gdp, prim_nums):
+    """Returns a copy of the geometry with only the prims numbered prim_nums"""
+    subset_gdp = hou.Geometry()
+    subset_gdp.merge(gdp)
+    if len(prim_nums) < len(subset_gdp.iterPrims()):
+        subset_gdp.deletePrims(
+            [prim for prim in subset_gdp.prims() if prim.number() not in prim_nums]
+        )
+    return subset_gdp
+
+
+def packed_local_geo(gdp, prim):
+    """Returns the unpacked geometry of a packed prim without its transform
+
+    Other than for embedded geometry this copies the whole of gdp, so the
+    gdp should only contain the prims that need unpacking.
+
+    Args:
+        gdp (hou.Geometry): Geometry containing the prim
+        prim (hou.PackedPrim): Packed primitive to unpack
+    Returns: hou.Geometry
+    """
+    local_gdp = hou.Geometry()
+    if isinstance(prim, hou.PackedGeometry):
+        local_gdp.merge(prim.getEmbeddedGeometry())
+        return _unpack(local_gdp)
+    local_gdp = _prim_subset(gdp, set([prim.number()]))
+    local_gdp = _unpack(local_gdp)
+    local_gdp.transform(prim.fullTransform().inverted())
+    return local_gdp
+
+
+def _paramset_key(paramset):
+    return tuple(sorted(str(x) for x in paramset))
+
+
+def packed_wrangler(gdp, paramset=None, properties=None, override_node=None):
+    """Outputs packed prims as ObjectInstances of shared prototypes
+
+    Packed prims are identified by the intrinsics of their shared geometry,
+    see PACKED_IDENTITY_INTRINSICS, and prims sharing geometry share a single
+    ObjectBegin prototype which is only unpacked once. Each prim is output
+    as an ObjectInstance using its packed transform. Prototypes are shared
+    within an object, and also depend on the material and overrides which
+    are captured at definition. Prims which don't share their geometry are
+    unpacked and output in place.
+
+    Args:
+        gdp (hou.Geometry): Input geo
+        paramset (ParamSet): Any base params to add to the shape. (Optional)
+        properties (dict): Dictionary of SohoParms (Optional)
+    Returns: None
+    """
+    if properties is None:
+        properties = {}
+
+    prims = gdp.prims()
+    shape_paramsets = []
+    for prim in prims:
+        shape_paramset = ParamSet(paramset)
+        shape_paramset |= prim_override(prim, override_node)
+        shape_paramsets.append(shape_paramset)
+
+    # Object definitions can't be nested, so within one every prim is
+    # unpacked in place.
+    keys = [None] * len(prims)
+    prototypes = properties.setdefault(".packed_prototypes", {})
+    if not api.in_object_definition():
+        material = properties.get(".material", "")
+        for i, prim in enumerate(prims):
+            identity = packed_identity(prim)
+            if identity is not None:
+                keys[i] = (material, _paramset_key(shape_paramsets[i]), identity)
+        counts = collections.Counter(keys)
+        keys = [key if key in prototypes or counts[key] > 1 else None for key in keys]
+
+    # Prims are grouped by their overrides so they are unpacked all at once
+    in_place = collections.OrderedDict()
+    for i, key in enumerate(keys):
+        if key is None:
+            in_place.setdefault(_paramset_key(shape_paramsets[i]), []).append(i)
+    for prim_nums in in_place.itervalues():
+        scene_state.stats.add("Packed prims unpacked in place", len(prim_nums))
+        unpacked_gdp = _unpack(_prim_subset(gdp, set(prim_nums)))
+        output_packed_prototype(unpacked_gdp, shape_paramsets[prim_nums[0]], properties)
+        unpacked_gdp.clear()
+
+    # Only the first prim of each new prototype is unpacked. Those which are
+    # not embedded are unpacked from a copy holding just them, rather than
+    # copying all of the prims for each.
+    new_prototypes = collections.OrderedDict()
+    for i, key in enumerate(keys):
+        if key is not None and key not in prototypes:
+            new_prototypes.setdefault(key, i)
+    if not new_prototypes:
+        misses_gdp = None
+    elif all(isinstance(prims[i], hou.PackedGeometry) for i in new_prototypes.values()):
+        misses_gdp = gdp
+    else:
+        misses_gdp = _prim_subset(gdp, set(new_prototypes.itervalues()))
+    if misses_gdp is not None:
+        misses_prims = misses_gdp.prims()
+
+    if "object:soppath" in properties:
+        soppath = properties["object:soppath"].Value[0]
+    else:
+        soppath = ""
+    for miss, (key, i) in enumerate(new_prototypes.iteritems()):
+        if misses_gdp is gdp:
+            local_gdp = packed_local_geo(gdp, prims[i])
+        else:
+            local_gdp = packed_local_geo(misses_gdp, misses_prims[miss])
+        prototype = "%s:packed%i" % (soppath, len(scene_state.packed_prototypes))
+        scene_state.packed_prototypes.add(prototype)
+        prototypes[key] = prototype
+        scene_state.stats.add("Packed prim prototypes")
+        # ObjectBegin captures the current transform, so the object's
+        # transform is reset within the definition.
+        with api.ObjectBlock(prototype):
+            api.Identity()
+            output_packed_prototype(local_gdp, shape_paramsets[i], properties)
+        local_gdp.clear()
+
+    for prim, key in itertools.izip(prims, keys):
+        if key is None:
+            continue
+        scene_state.stats.add("Packed prim instances")
+        with api.TransformBlock():
+            api.ConcatTransform(prim.fullTransform().asTuple())
+            api.ObjectInstance(prototypes[key])
+    scene_state.stats.add_ratio(
+        "Packed prim prototype reuse",
+        "Packed prim prototypes",
+        "Packed prim instances",
+    )
+    return
+
+
+def output_packed_prototype(gdp, paramset, properties):
+    """Outputs the shapes of a packed prim's unpacked geometry
+
+    Args:
+        gdp (hou.Geometry): Unpacked geometry
+        paramset (ParamSet): Any base params to add to the shapes.
+        properties (dict): Dictionary of SohoParms
+    Returns: None
+    """
+    # The unpacked geometry is not the part of the SOP's geometry that
+    # .geo_key identifies.
+    properties = dict(properties)
+    properties.pop(".geo_key", None)
+    shape_gdps = partition_by_attrib(gdp, "typename", intrinsic=True)
+    for shape, shape_gdp in shape_gdps.iteritems():
+        shape_wrangler = shape_wranglers.get(shape, not_supported)
+        shape_wrangler(shape_gdp, paramset, properties, None)
+        shape_gdp.clear()
+    return
+
+
 def tube_wrangler(gdp, paramset=None, properties=None, override_node=None):
     """Outputs "cone" or "cylinder" Shapes for the input geometry
 
@@ -239,7 +585,12 @@ def mesh_wrangler(gdp, paramset=None, properties=None, override_node=None):
     """Outputs meshes (trianglemesh or loopsubdiv) depending on properties
 
     If the pbrt_rendersubd property is set and true, a loopsubdiv shape will
-    be generated, otherwise a trianglemesh
+    be generated, otherwise a trianglemesh. If pbrt_predicesubd is also true
+    the subdivision happens during export and a trianglemesh (or a plymesh
+    when a cache directory is set) is generated instead.
+
+    If pbrt_lod is set and true, trianglemeshes are decimated based on their
+    size on screen.
 
     Args:
         gdp (hou.Geometry): Input geo
@@ -274,15 +625,69 @@ def mesh_wrangler(gdp, paramset=None, properties=None, override_node=None):
 
     gdp = scene_state.tesselate_geo(gdp)
 
+    computeN = True
+    if "pbrt_computeN" in properties:
+        computeN = properties["pbrt_computeN"].Value[0]
+
+    predice = False
     if shape == "loopsubdiv":
-        wrangler_paramset = loopsubdiv_params(gdp)
+        # pbrt-v3's loopsubdiv defaults to 3 levels
+        levels = 3
         if "levels" in properties:
-            wrangler_paramset.replace(properties["levels"].to_pbrt())
+            levels = properties["levels"].Value[0]
+        if "pbrt_subdauto" in properties and properties["pbrt_subdauto"].Value[0]:
+            levels = adaptive_subd_level(
+                gdp,
+                properties.get(".xform"),
+                properties["subdedgelength"].Value[0],
+                levels,
+            )
+            scene_state.stats.add("Objects at auto subdivision level %i" % levels)
+        if "pbrt_predicesubd" in properties:
+            predice = properties["pbrt_predicesubd"].Value[0]
+
+    if predice:
+        cache_dir = None
+        if "cachedir" in properties:
+            cache_dir = properties["cachedir"].Value[0]
+        shape, wrangler_paramset = prediced_loopsubdiv_params(
+            gdp, levels, computeN, cache_dir
+        )
+        wrangler_paramset.update(mesh_alpha_texs(properties))
+    elif shape == "loopsubdiv":
+        wrangler_paramset = loopsubdiv_params(gdp)
+        wrangler_paramset.add(PBRTParam("integer", "levels", levels))
     else:
-        computeN = True
-        if "pbrt_computeN" in properties:
-            computeN = properties["pbrt_computeN"].Value[0]
-        wrangler_paramset = trianglemesh_params(gdp, computeN)
+        scene_state.stats.add(
+            "Scene triangles before LOD", gdp.intrinsicValue("primitivecount")
+        )
+        if "pbrt_lod" in properties and properties["pbrt_lod"].Value[0]:
+            gdp = lod_decimate(
+                gdp,
+                properties.get(".xform"),
+                properties["lodedgelength"].Value[0],
+                properties.get(".geo_key"),
+                properties["lodmargin"].Value[0],
+            )
+        scene_state.stats.add(
+            "Scene triangles after LOD", gdp.intrinsicValue("primitivecount")
+        )
+        scene_state.stats.add_ratio(
+            "LOD triangle reduction",
+            "Scene triangles after LOD",
+            "Scene triangles before LOD",
+        )
+        weld_tolerance = None
+        if "pbrt_weld" in properties and properties["pbrt_weld"].Value[0]:
+            weld_tolerance = 0.0
+            if "weldtolerance" in properties:
+                weld_tolerance = properties["weldtolerance"].Value[0]
+        spatial_order = False
+        if "pbrt_spatialorder" in properties:
+            spatial_order = properties["pbrt_spatialorder"].Value[0]
+        wrangler_paramset = trianglemesh_params(
+            gdp, computeN, weld_tolerance, spatial_order
+        )
         alpha_paramset = mesh_alpha_texs(properties)
         wrangler_paramset.update(alpha_paramset)
 
@@ -293,7 +698,9 @@ def mesh_wrangler(gdp, paramset=None, properties=None, override_node=None):
     return None
 
 
-def trianglemesh_params(mesh_gdp, computeN=True):
+def trianglemesh_params(
+    mesh_gdp, computeN=True, weld_tolerance=None, spatial_order=False
+):
     """Generates a ParamSet for a trianglemesh
 
     The following attributes are checked for -
@@ -307,6 +714,13 @@ def trianglemesh_params(mesh_gdp, computeN=True):
         mesh_gdp (hou.Geometry): Input geo
         computeN (bool): Whether to auto-compute normals if they don't exist
                          Defaults to True
+        weld_tolerance (float, None): If not None, points with the same
+                                      P, N, uv and S values (within the
+                                      tolerance) are welded together.
+                                      Defaults to None
+        spatial_order (bool): Whether to sort the triangles and points in
+                              Morton order of the triangle centroids
+                              Defaults to False
     Returns: ParamSet of the attributes on the geometry
     """
 
@@ -403,6 +817,35 @@ def trianglemesh_params(mesh_gdp, computeN=True):
         uv = array.array("f")
         uv.fromstring(mesh_gdp.pointFloatAttribValuesAsString("uv"))
 
+    if weld_tolerance is not None or spatial_order:
+        attribs = [x for x in (P, N, S, uv) if x is not None]
+        prim_attribs = [faceIndices] if faceIndices is not None else []
+
+        # Uniquing the points above splits every vertex, even though most of
+        # them will share the same values. Welding merges them back together.
+        if weld_tolerance is not None:
+            num_pts = len(P) // 3
+            indices, attribs = weld_vertices(indices, attribs, weld_tolerance)
+            scene_state.stats.add("Weld input points", num_pts)
+            scene_state.stats.add("Weld output points", len(attribs[0]) // 3)
+            scene_state.stats.add_ratio(
+                "Weld reduction", "Weld output points", "Weld input points"
+            )
+
+        if spatial_order:
+            indices, attribs, prim_attribs = spatial_reorder(
+                indices, attribs, prim_attribs
+            )
+            scene_state.stats.add("Spatially reordered meshes")
+
+        attribs = iter(attribs)
+        P = next(attribs)
+        N = None if N is None else next(attribs)
+        S = None if S is None else next(attribs)
+        uv = None if uv is None else next(attribs)
+        if faceIndices is not None:
+            faceIndices = prim_attribs[0]
+
     mesh_paramset.add(PBRTParam("integer", "indices", indices))
     mesh_paramset.add(PBRTParam("point", "P", P))
     if N is not None:
@@ -452,6 +895,288 @@ def loopsubdiv_params(mesh_gdp):
     return mesh_paramset
 
 
+def average_edge_length(mesh_gdp, samples=1024):
+    """Estimates the average edge length of a mesh
+
+    Only a strided subset of the primitives are measured so the cost is
+    bounded for dense meshes.
+    """
+    num_prims = mesh_gdp.intrinsicValue("primitivecount")
+    if not num_prims:
+        return 0.0
+    step = max(1, num_prims // samples)
+    prims = mesh_gdp.iterPrims()
+    total = 0.0
+    count = 0
+    for i in xrange(0, num_prims, step):
+        positions = [pt.position() for pt in prims[i].points()]
+        for j in xrange(len(positions)):
+            total += (positions[j] - positions[j - 1]).length()
+        count += len(positions)
+    if not count:
+        return 0.0
+    return total / count
+
+
+def adaptive_subd_level(mesh_gdp, xform, edge_length, max_levels):
+    """Picks a loop subdivision level based on the mesh's size on screen
+
+    Each level of Loop subdivision halves the edge lengths, so the level is
+    chosen such that the subdivided edges project to roughly edge_length
+    pixels on screen.
+
+    Args:
+        mesh_gdp (hou.Geometry): Input geo
+        xform (hou.Matrix4): The object to world transform
+        edge_length (float): Target edge length in pixels
+        max_levels (int): Maximum level, returned if the view is not known
+    Returns: int
+    """
+    view = scene_state.camera_view
+    if view is None or xform is None or edge_length <= 0:
+        return max_levels
+    bbox = mesh_gdp.boundingBox()
+    diagonal = bbox.sizevec().length()
+    if not diagonal:
+        return 0
+    # The edge length is measured as a fraction of the bounds so the
+    # projected size of the bounds can be used to estimate its pixel length.
+    edge_pixels = view.projected_size(bbox, xform)
+    edge_pixels *= average_edge_length(mesh_gdp) / diagonal
+    if edge_pixels <= edge_length:
+        return 0
+    level = int(math.ceil(math.log(edge_pixels / edge_length, 2)))
+    return min(level, max_levels)
+
+
+# Meshes are never reduced below this many triangles, tiny meshes may still
+# be seen up close in reflections or through refractions.
+LOD_MIN_BUDGET = 64
+
+
+def lod_reduction(pixel_size, edge_length, num_tris):
+    """Returns the triangle budget and polyreduce percentage for a mesh
+
+    The triangle budget is chosen so the triangles project to roughly
+    edge_length pixels. It is rounded up to a power of 2 so small changes in
+    the view between frames still reuse the cached results, and is never
+    less than LOD_MIN_BUDGET.
+
+    Args:
+        pixel_size (float): Size of the mesh on screen in pixels
+        edge_length (float): Target edge length in pixels
+        num_tris (int): Number of triangles in the mesh
+    Returns:
+        A tuple of the (int) budget and (float) percentage of the triangles
+        to keep, or None if the mesh is already within the budget.
+    """
+    # A square with n edges per side holds 2 * n^2 triangles
+    budget = 2.0 * (pixel_size / edge_length) ** 2
+    budget = 2 ** int(math.ceil(math.log(max(budget, LOD_MIN_BUDGET), 2)))
+    if budget >= num_tris:
+        return None
+    return budget, 100.0 * budget / num_tris
+
+
+def lod_decimate(mesh_gdp, xform, edge_length, source_key=None, margin=0.0):
+    """Decimates a triangle mesh to a budget based on its size on screen
+
+    The decimated result is cached by the source mesh and budget so
+    repeated exports don't need to decimate again. Meshes outside of the
+    camera's view, such as those behind it, have no meaningful size on screen
+    and are left as is.
+
+    Args:
+        mesh_gdp (hou.Geometry): Input geo, must consist of only triangles
+        xform (hou.Matrix4): The object to world transform
+        edge_length (float): Target edge length in pixels
+        source_key (tuple): Key identifying where mesh_gdp came from, such as
+                            a PBRTcache.sop_key. If not given the mesh is
+                            identified by a geo_hash. (Optional)
+        margin (float): Distance to expand the camera's view by when checking
+                        if the mesh is in view. (Optional)
+    Returns: hou.Geometry, either mesh_gdp or a decimated version
+    """
+    view = scene_state.camera_view
+    if view is None or xform is None or edge_length <= 0:
+        return mesh_gdp
+    num_tris = mesh_gdp.intrinsicValue("primitivecount")
+    if not num_tris:
+        return mesh_gdp
+
+    bbox = mesh_gdp.boundingBox()
+    if not view.in_frustum(bbox, xform, margin):
+        scene_state.stats.add("LOD skipped outside of view")
+        return mesh_gdp
+    size = view.projected_size(bbox, xform)
+    reduction = lod_reduction(size, edge_length, num_tris)
+    if reduction is None:
+        return mesh_gdp
+    budget, percentage = reduction
+
+    if source_key is not None:
+        key = source_key + ("polyreduce", budget)
+    else:
+        key = PBRTcache.geo_hash(mesh_gdp, "polyreduce", budget)
+    lod_gdp = PBRTcache.get_cached_geo(key)
+    if lod_gdp is not None:
+        scene_state.stats.add("LOD cache hits")
+        return lod_gdp
+
+    scene_state.stats.add("LOD cache misses")
+    lod_gdp = hou.Geometry()
+    lod_gdp.merge(mesh_gdp)
+    reduce_verb = hou.sopNodeTypeCategory().nodeVerb("polyreduce")
+    reduce_verb.setParms({"percentage": percentage})
+    reduce_verb.execute(lod_gdp, [lod_gdp])
+    PBRTcache.cache_geo(key, lod_gdp)
+    return lod_gdp
+
+
+def subdivide_menu_token(label):
+    """Returns the token of the Subdivide SOP's algorithm menu item with label
+
+    The menu's order differs between Houdini versions, so the token is
+    looked up by its label rather than relying on an index.
+
+    Raises:
+        ValueError: If no algorithm has the label
+    """
+    subdivide_type = hou.sopNodeTypeCategory().nodeTypes()["subdivide"]
+    template = subdivide_type.parmTemplateGroup().find("algorithm")
+    for token, menu_label in zip(template.menuItems(), template.menuLabels()):
+        if menu_label == label:
+            return token
+    raise ValueError("Subdivide SOP has no %s algorithm" % label)
+
+
+def _loopsubdiv_key(mesh_gdp, levels, computeN):
+    """The cache key of a pre-diced mesh, shared by the geo and PLY caches"""
+    return PBRTcache.geo_hash(mesh_gdp, "loopsubdiv", levels, computeN)
+
+
+def predice_loopsubdiv(mesh_gdp, levels, computeN=True):
+    """Subdivides a triangle mesh with the Loop scheme
+
+    Args:
+        mesh_gdp (hou.Geometry): Input geo, must consist of only triangles
+        levels (int): Number of subdivision iterations
+        computeN (bool): Whether normals will be computed for the result,
+                         part of the cache key. Defaults to True
+    Returns: hou.Geometry of the subdivided mesh, which may be a cached copy
+    """
+
+    key = _loopsubdiv_key(mesh_gdp, levels, computeN)
+    diced_gdp = PBRTcache.get_cached_geo(key)
+    if diced_gdp is not None:
+        scene_state.stats.add("Pre-diced subdivision cache hits")
+        return diced_gdp
+
+    scene_state.stats.add("Pre-diced subdivision cache misses")
+    diced_gdp = hou.Geometry()
+    diced_gdp.merge(mesh_gdp)
+    subd_verb = hou.sopNodeTypeCategory().nodeVerb("subdivide")
+    subd_verb.setParms(
+        {"iterations": levels, "algorithm": subdivide_menu_token("OpenSubdiv Loop")}
+    )
+    subd_verb.execute(diced_gdp, [diced_gdp])
+    PBRTcache.cache_geo(key, diced_gdp)
+    return diced_gdp
+
+
+def prediced_loopsubdiv_params(mesh_gdp, levels, computeN=True, cache_dir=None):
+    """Generates the shape and ParamSet for a pre-diced loopsubdiv
+
+    pbrt refines loopsubdiv shapes single threaded while parsing the scene,
+    which for dense cages at high levels can take minutes. Instead the mesh is
+    subdivided here and output as a trianglemesh, or if a cache_dir is given
+    as a binary plymesh which is only written once per unique cage and level.
+
+    Args:
+        mesh_gdp (hou.Geometry): Input geo, must consist of only triangles
+        levels (int): Number of subdivision iterations
+        computeN (bool): Whether to auto-compute normals if they don't exist
+                         Defaults to True
+        cache_dir (str): Directory to write PLY files to (Optional)
+    Returns: tuple of the shape name and its ParamSet
+    """
+
+    if not cache_dir:
+        diced_gdp = predice_loopsubdiv(mesh_gdp, levels, computeN)
+        return "trianglemesh", trianglemesh_params(diced_gdp, computeN)
+
+    key = _loopsubdiv_key(mesh_gdp, levels, computeN)
+    filename = PBRTcache.cache_filename(cache_dir, key)
+    if os.path.exists(filename):
+        scene_state.stats.add("Pre-diced subdivision PLY reuses")
+    else:
+        diced_gdp = predice_loopsubdiv(mesh_gdp, levels, computeN)
+        write_trianglemesh_ply(filename, trianglemesh_params(diced_gdp, computeN))
+        scene_state.stats.add("Pre-diced subdivision PLY writes")
+
+    paramset = ParamSet()
+    paramset.add(PBRTParam("string", "filename", filename))
+    return "plymesh", paramset
+
+
+def write_trianglemesh_ply(filename, mesh_paramset):
+    """Writes the P, indices, N and uv of a trianglemesh ParamSet as a PLY"""
+    ply_attribs = {}
+    for ptype, name in (("normal", "N"), ("float", "uv")):
+        param = mesh_paramset.find_param(ptype, name)
+        if param is not None:
+            ply_attribs[name] = param.value
+    PBRTcache.write_ply(
+        filename,
+        mesh_paramset.find_param("point", "P").value,
+        mesh_paramset.find_param("integer", "indices").value,
+        **ply_attribs
+    )
+    return
+
+
+def packeddisk_ply(filename, computeN=True, cache_dir=None):
+    """Returns a PLY file pbrt can load for a packed disk primitive's file
+
+    Files which are not PLYs, such as .bgeo.sc or .obj, are loaded,
+    triangulated and written as binary PLYs to the cache_dir. The cached
+    file is named by a hash of the source file's path, mtime and size so a
+    file is only converted again once it changes.
+
+    Args:
+        filename (str): Packed disk file
+        computeN (bool): Whether to auto-compute normals if they don't exist
+                         Defaults to True
+        cache_dir (str): Directory to write PLY files to (Optional)
+    Returns: The path to a PLY or None if the file can not be converted
+    """
+    if os.path.splitext(filename)[1].lower() == ".ply":
+        return filename
+    if not cache_dir:
+        return None
+
+    try:
+        key = PBRTcache.file_key(filename, computeN)
+    except OSError:
+        return None
+    ply_filename = PBRTcache.cache_filename(cache_dir, key)
+    if os.path.exists(ply_filename):
+        scene_state.stats.add("Packed disk PLY reuses")
+        return ply_filename
+
+    gdp = hou.Geometry()
+    try:
+        gdp.loadFromFile(filename)
+    except hou.OperationFailed:
+        return None
+    gdp = scene_state.tesselate_geo(gdp)
+    if not gdp.intrinsicValue("primitivecount"):
+        return None
+    write_trianglemesh_ply(ply_filename, trianglemesh_params(gdp, computeN))
+    scene_state.stats.add("Packed disk PLY conversions")
+    return ply_filename
+
+
 def volume_wrangler(gdp, paramset=None, properties=None, override_node=None):
     """Call either the smoke_prim_wrangler or heightfield_wrangler"""
 
@@ -1062,6 +1787,9 @@ shape_wranglers = {
     "NURBCurve": curve_wrangler,
     "Volume": volume_wrangler,
     "PackedDisk": packeddisk_wrangler,
+    "PackedGeometry": packed_wrangler,
+    "PackedFragment": packed_wrangler,
+    "AlembicRef": packed_wrangler,
     "TriFan": tesselated_wrangler,
     "TriStrip": tesselated_wrangler,
     "TriBezier": tesselated_wrangler,
@@ -1171,6 +1899,7 @@ def output_geo(soppath, now, properties=None):
         return
     gdp = hou.Geometry()
     gdp.merge(input_gdp.freeze())
+    sop_key = PBRTcache.sop_key(node, ignore_materials)
 
     default_material = ""
     default_override = ""
@@ -1208,6 +1937,7 @@ def output_geo(soppath, now, properties=None):
     del prim_material_h
 
     for material, material_gdp in material_gdps.iteritems():
+        material_partition = material
 
         if material not in scene_state.shading_nodes:
             if material in scene_state.invalid_shading_nodes:
@@ -1218,6 +1948,9 @@ def output_geo(soppath, now, properties=None):
             api.AttributeBegin()
             api.NamedMaterial(material)
             material_node = MaterialNode(material)
+        # Packed prim prototypes capture the material, so they need to know
+        # which one is bound.
+        properties[".material"] = material
 
         shape_gdps = partition_by_attrib(material_gdp, "typename", intrinsic=True)
         material_gdp.clear()
@@ -1274,6 +2007,14 @@ def output_geo(soppath, now, properties=None):
                 #   prim_overrides flag either in the properties or as its own function
                 #   arg.
 
+                # Identifies this partition of the SOP's geometry so
+                # wranglers can cache work without hashing the geometry.
+                properties[".geo_key"] = sop_key + (
+                    material_partition,
+                    shape,
+                    override,
+                )
+
                 shape_wrangler = shape_wranglers.get(shape, not_supported)
                 if shape_wrangler:
                     shape_wrangler(
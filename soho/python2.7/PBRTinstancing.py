@@ -1,5 +1,9 @@
 from __future__ import print_function, division, absolute_import
 
+import sys
+import math
+import array
+import itertools
 import collections
 
 import hou
@@ -7,17 +11,115 @@ import soho
 from sohog import SohoGeometry
 
 import PBRTapi as api
+from PBRTnodes import canonical_override
+from PBRTstate import scene_state
 
 _FullInstance = collections.namedtuple(
-    "_FullInstance", ["instance", "source", "number", "gdp"]
+    "_FullInstance", ["instance", "source", "number", "gdp", "attribs"]
 )
 
+# Point attributes on full instancers which are looked up per instance
+FULL_INSTANCE_ATTRIBS = (
+    "shop_materialpath",
+    "material_override",
+    "pbrt_interior",
+    "pbrt_exterior",
+) + tuple(
+    "%s_%s" % (medium_type, parm)
+    for medium_type in ("interior", "exterior")
+    for parm in ("sigma_a", "sigma_s", "preset", "g", "scale")
+)
+
+
+_HybridInstances = collections.namedtuple(
+    "_HybridInstances", ["prototypes", "point_prototypes"]
+)
+
+_FastInstances = collections.namedtuple(
+    "_FastInstances", ["points", "prototypes", "xforms", "usage"]
+)
+
+
+def _sop_geometry(sop_node, now):
+    """Returns a SOP's geometry at the time now
+
+    Unlike SohoGeometry, hou.Geometry allows fetching attributes in bulk,
+    but SopNode.geometry() is evaluated at the current time which may differ
+    from the time being output, such as for motion blur segments.
+    """
+    return sop_node.geometryAtFrame(hou.timeToFrame(now))
+
+
+def _fetch_point_attribs(sop_path, names, now):
+    """Bulk fetch point attributes as a list of per point value tuples
+
+    The attributes are cached for the duration of a render, including empty
+    results for SOPs which don't exist, as an instancer's attributes are
+    looked up for each of its prototypes as well as its instances. The
+    returned dict is shared so it must not be modified.
+
+    Args:
+        sop_path (str): Path to the SOP
+        names (iterable): Attribute names to fetch, missing ones are skipped
+        now (float): Time to evaluate the SOP's geometry at
+    Returns: dict of attribute name to list of values
+    """
+    key = (sop_path, tuple(names), now)
+    if key in scene_state.point_attribs:
+        scene_state.stats.add("Point attribute cache hits")
+        return scene_state.point_attribs[key]
+    scene_state.stats.add("Point attribute cache misses")
+
+    attribs = {}
+    scene_state.point_attribs[key] = attribs
+    sop_node = hou.node(sop_path)
+    if sop_node is None:
+        return attribs
+    geo = _sop_geometry(sop_node, now)
+    if geo is None:
+        return attribs
+    for name in names:
+        attrib = geo.findPointAttrib(name)
+        if attrib is None:
+            continue
+        data_type = attrib.dataType()
+        if data_type == hou.attribData.String:
+            values = geo.pointStringAttribValues(name)
+        elif data_type == hou.attribData.Float:
+            values = geo.pointFloatAttribValues(name)
+        elif data_type == hou.attribData.Int:
+            values = geo.pointIntAttribValues(name)
+        else:
+            continue
+        # Group the flat values into tuples of the attribute's size
+        attribs[name] = zip(*[iter(values)] * attrib.size())
+    return attribs
+
 
 def get_full_instance_info(obj, now):
     tokens = obj.getName().split(":")
     if len(tokens) != 3:
         return None
-    instancer_obj = soho.getObject(tokens[1])
+
+    # Every point of a full instancer is its own object, so the instancer's
+    # geometry and point attributes are only fetched once per render. An
+    # instancer without geometry is cached as None.
+    if tokens[1] in scene_state.full_instancers:
+        scene_state.stats.add("Full instancer cache hits")
+        cached = scene_state.full_instancers[tokens[1]]
+    else:
+        scene_state.stats.add("Full instancer cache misses")
+        cached = _full_instancer(tokens[1], now)
+        scene_state.full_instancers[tokens[1]] = cached
+    if cached is None:
+        return None
+    gdp, attribs = cached
+    return _FullInstance(tokens[0], tokens[1], int(tokens[2]), gdp, attribs)
+
+
+def _full_instancer(instancer, now):
+    """Returns a full instancer's SohoGeometry and point attributes or None"""
+    instancer_obj = soho.getObject(instancer)
     instancer_sop = []
     if not instancer_obj.evalString("object:soppath", now, instancer_sop):
         return None
@@ -25,49 +127,380 @@ def get_full_instance_info(obj, now):
     gdp = SohoGeometry(instancer_sop, now)
     if gdp is None:
         return None
-    return _FullInstance(tokens[0], tokens[1], int(tokens[2]), gdp)
+    return gdp, _fetch_point_attribs(instancer_sop, FULL_INSTANCE_ATTRIBS, now)
 
 
-def find_referenced_instances(obj):
-    """Find and list any used instances in a Soho Object"""
+def point_instance_geos(obj, now, obj_node, sop_node):
+    """Returns the instanced geometry's path for each point of an instancer
 
-    # We will be using a hou.Node instead of a Soho Object for this
-    # so we can just query the strings directly instead of having to
-    # iterate over all the points.
+    The instance strings are fetched all at once, and each unique string is
+    only resolved once. Points without an instance attribute, or with one
+    that does not resolve, use the object's instancepath.
+    """
+    instancepath = []
+    obj.evalString("instancepath", now, instancepath)
+    default_instance_geo = scene_state.resolve_path(obj_node, instancepath[0]) or ""
+
+    geo = _sop_geometry(sop_node, now)
+    instance_attrib = geo.findPointAttrib("instance")
+    if instance_attrib is None or instance_attrib.dataType() != hou.attribData.String:
+        return [default_instance_geo] * geo.intrinsicValue("pointcount")
+
+    pt_instance_geos = geo.pointStringAttribValues("instance")
+    resolved = {}
+    for pt_instance_geo in set(pt_instance_geos):
+        resolved[pt_instance_geo] = (
+            scene_state.resolve_path(sop_node, pt_instance_geo) or default_instance_geo
+        )
+    return [resolved[x] for x in pt_instance_geos]
 
-    obj_node = hou.node(obj.getName())
-    if not obj_node:
-        return
 
-    sop_node = obj_node.renderNode()
+def get_hybrid_instances(obj, now):
+    """Groups the points of a fast instancer by their geometry and material
+
+    pbrt ignores materials bound to ObjectInstances, so with hybrid
+    instancing each unique (instance geometry, shop_materialpath,
+    material_override) is given its own prototype with the material bound
+    within it. Prototypes are shared between instancers.
+
+    Returns:
+        _HybridInstances or None if hybrid instancing does not apply. Its
+        prototypes map a prototype's name to its instance geometry, shop and
+        override, and point_prototypes is the prototype name of each point.
+    """
+    name = obj.getName()
+    if name in scene_state.hybrid_instancers:
+        return scene_state.hybrid_instancers[name]
+    scene_state.hybrid_instancers[name] = None
+
+    if obj.getDefaultedInt("ptinstance", now, [0])[0] != 2:
+        return None
+    if not obj.getDefaultedInt("pbrt_hybridinstancing", now, [0])[0]:
+        return None
+
+    soppath = []
+    if not obj.evalString("object:soppath", now, soppath):
+        return None
+    obj_node = hou.node(name)
+    sop_node = hou.node(soppath[0])
+    if obj_node is None or sop_node is None:
+        return None
+
+    attribs = _fetch_point_attribs(
+        soppath[0], ("shop_materialpath", "material_override"), now
+    )
+    shops = attribs.get("shop_materialpath")
+    if shops is None:
+        return None
+    overrides = attribs.get("material_override")
+
+    prototypes = collections.OrderedDict()
+    point_prototypes = []
+    instance_geos = point_instance_geos(obj, now, obj_node, sop_node)
+    for pt, instance_geo in enumerate(instance_geos):
+        shop = shops[pt][0]
+        if not instance_geo or not shop:
+            # Points without a material use the regular prototype
+            point_prototypes.append(instance_geo)
+            continue
+        override_str = overrides[pt][0] if overrides is not None else ""
+        key = (instance_geo, shop, canonical_override(override_str))
+        prototype = scene_state.hybrid_prototypes.get(key)
+        if prototype is None:
+            prototype = "%s:hybrid%i" % (
+                instance_geo,
+                len(scene_state.hybrid_prototypes),
+            )
+            scene_state.hybrid_prototypes[key] = prototype
+            scene_state.stats.add("Hybrid instance prototypes")
+        prototypes[prototype] = (instance_geo, shop, override_str)
+        point_prototypes.append(prototype)
+
+    hybrid_instances = _HybridInstances(prototypes, point_prototypes)
+    scene_state.hybrid_instancers[name] = hybrid_instances
+    return hybrid_instances
+
+
+def _max_scale(xform):
+    """The largest scale along any axis of a hou.Matrix4"""
+    return max(
+        math.sqrt(sum(xform.at(row, col) ** 2 for col in range(3))) for row in range(3)
+    )
+
+
+def _culled(camera_view, center, radius, margin=0.0, min_pixels=0.0):
+    """Whether an instance's bounding sphere is out of view or too small
+
+    Args:
+        camera_view (CameraView): The render camera's view
+        center (hou.Vector3): World space center of the sphere
+        radius (float): World space radius of the sphere
+        margin (float): Distance to expand the sphere by when testing it
+                        against the view (Optional)
+        min_pixels (float): Spheres smaller than this many pixels on screen
+                            are culled, 0 disables this (Optional)
+    Returns: bool
+    """
+    if not camera_view.sphere_in_frustum(center, radius + margin):
+        return True
+    if min_pixels > 0:
+        return camera_view.sphere_pixel_size(center, radius) < min_pixels
+    return False
+
+
+def _prototype_sphere(instance_geo, now):
+    """Returns the bounding sphere of an instanced object's geometry
+
+    The sphere is in the space the ObjectInstances are transformed from,
+    which includes the instanced object's own transform.
+
+    Returns:
+        A tuple of (hou.Vector3 center, float radius) or None if the bounds
+        are unknown, in which case the instances are never culled.
+    """
+    if instance_geo in scene_state.prototype_bounds:
+        return scene_state.prototype_bounds[instance_geo]
+    scene_state.prototype_bounds[instance_geo] = None
+
+    node = hou.node(instance_geo)
+    if node is None or node.type().category() != hou.objNodeTypeCategory():
+        return None
+    # Nested instancers' bounds don't represent what they output
+    for parm_name in ("ptinstance", "instancepath"):
+        parm = node.parm(parm_name)
+        if parm is not None and parm.evalAtTime(now):
+            return None
+    sop_node = node.renderNode()
     if sop_node is None:
-        return
+        return None
+    gdp = _sop_geometry(sop_node, now)
+    if gdp is None or not gdp.intrinsicValue("pointcount"):
+        return None
 
-    geo = sop_node.geometry()
-    if geo is None:
-        return
+    bbox = gdp.boundingBox()
+    xform = node.worldTransformAtTime(now)
+    sphere = (
+        bbox.center() * xform,
+        0.5 * bbox.sizevec().length() * _max_scale(xform),
+    )
+    scene_state.prototype_bounds[instance_geo] = sphere
+    return sphere
 
-    # Get the full path to any point instance geos
-    instance_attrib = geo.findPointAttrib("instance")
-    if (
-        instance_attrib is not None
-        and instance_attrib.dataType() == hou.attribData.String
-    ):
-        for instance_str in instance_attrib.strings():
-            instance_obj = sop_node.node(instance_str)
-            if instance_obj:
-                yield instance_obj.path()
 
-    # Get the object's instancepath as well
-    instancepath_parm = obj_node.parm("instancepath")
-    if instancepath_parm:
-        instance_obj = instancepath_parm.evalAsNode()
-        if instance_obj:
-            yield instance_obj.path()
+def _lod_variants(instance_geo):
+    """Returns the instanced object followed by its lower detail variants
+
+    Variants are found by name, /obj/tree's variants are /obj/tree_lod1,
+    /obj/tree_lod2 and so on, each with less detail than the last.
+    """
+    variants = scene_state.lod_variants.get(instance_geo)
+    if variants is not None:
+        return variants
+    variants = [instance_geo]
+    while True:
+        variant = "%s_lod%i" % (instance_geo, len(variants))
+        node = hou.node(variant)
+        if node is None or node.type().category() != hou.objNodeTypeCategory():
+            break
+        variants.append(variant)
+    scene_state.lod_variants[instance_geo] = variants
+    return variants
 
 
-def wrangle_fast_instances(obj, now):
-    """Output instanced geoemtry defined by fast instancing"""
+def _lod_level(pixel_size, lod_size):
+    """The LOD level for an instance of the given size on screen
+
+    Instances at least lod_size pixels across use the full detail level 0,
+    those smaller but at least half that size use level 1, then a quarter
+    level 2 and so on.
+    """
+    if pixel_size >= lod_size:
+        return 0
+    if pixel_size <= 0.0:
+        return sys.maxint
+    # Halving rather than a log2 keeps the thresholds exact
+    level = 1
+    lod_size *= 0.5
+    while pixel_size < lod_size:
+        level += 1
+        lod_size *= 0.5
+    return level
+
+
+def _flattened_instances(instance_geo, now):
+    """Returns the instances of a fast instancer used as an instance
+
+    pbrt-v3 does not allow ObjectInstances within an ObjectBegin, so
+    instancing a fast instancer has to be flattened into instances of its
+    own prototypes. Nested instancers are flattened recursively.
+
+    Returns:
+        A list of (prototype, hou.Matrix4) of each leaf instance, with the
+        transform relative to the instancer's own prototype space, or None
+        if the instance_geo is not a fast instancer.
+    """
+    if instance_geo in scene_state.flattened_instancers:
+        return scene_state.flattened_instancers[instance_geo]
+    # Also guards against an instancer which instances itself
+    scene_state.flattened_instancers[instance_geo] = None
+
+    node = hou.node(instance_geo)
+    if node is None or node.type().category() != hou.objNodeTypeCategory():
+        return None
+    ptinstance = node.parm("ptinstance")
+    if ptinstance is None or ptinstance.evalAtTime(now) != 2:
+        return None
+    sop_node = node.renderNode()
+    if sop_node is None:
+        return None
+    obj = soho.getObject(instance_geo)
+    geo = SohoGeometry(sop_node.path(), now)
+    xform_h = geo.attribute("geo:point", "geo:pointxform")
+    if xform_h < 0:
+        return None
+
+    instancer_xform = node.worldTransformAtTime(now)
+    flattened = []
+    for pt, prototype in enumerate(point_instance_geos(obj, now, node, sop_node)):
+        if not prototype:
+            continue
+        xform = hou.Matrix4(geo.value(xform_h, pt)) * instancer_xform
+        nested = _flattened_instances(prototype, now)
+        if nested is None:
+            flattened.append((prototype, xform))
+        else:
+            flattened.extend((leaf, leaf_xform * xform) for leaf, leaf_xform in nested)
+    scene_state.flattened_instancers[instance_geo] = flattened
+    return flattened
+
+
+def get_fast_instances(obj, now):
+    """Determines which points of a fast instancer are output
+
+    Points are resolved to their prototype, either their instanced geometry
+    or their hybrid instance prototype. If pbrt_cullinstances is enabled,
+    points whose instance's bounding sphere is entirely outside of the
+    camera's view, or smaller on screen than pbrt_instancecullsize, are
+    removed. If pbrt_instancelod is enabled, points instancing an object
+    with LOD variants use a variant chosen by the instance's size on screen.
+    Points instancing another fast instancer are flattened into instances
+    of its prototypes.
+
+    Returns:
+        _FastInstances or None if the object is not a fast instancer. Its
+        points and prototypes are the point number and prototype name of
+        each output instance. xforms is the transform of each instance if
+        it differs from its point's, such as for flattened nested
+        instances, otherwise None. usage counts the instances per prototype
+        in the order the prototypes are first used.
+    """
+    name = obj.getName()
+    if name in scene_state.fast_instancers:
+        return scene_state.fast_instancers[name]
+    scene_state.fast_instancers[name] = None
+
+    if obj.getDefaultedInt("ptinstance", now, [0])[0] != 2:
+        return None
+
+    soppath = []
+    if not obj.evalString("object:soppath", now, soppath):
+        return None
+    obj_node = hou.node(name)
+    sop_node = hou.node(soppath[0])
+    if obj_node is None or sop_node is None:
+        return None
+
+    hybrid_instances = get_hybrid_instances(obj, now)
+    if hybrid_instances is not None:
+        point_prototypes = hybrid_instances.point_prototypes
+    else:
+        point_prototypes = point_instance_geos(obj, now, obj_node, sop_node)
+
+    camera_view = scene_state.camera_view
+    cull = lod = False
+    if camera_view is not None:
+        cull = obj.getDefaultedInt("pbrt_cullinstances", now, [0])[0]
+        lod = obj.getDefaultedInt("pbrt_instancelod", now, [0])[0]
+    geo = SohoGeometry(soppath[0], now)
+    xform_h = geo.attribute("geo:point", "geo:pointxform")
+    if xform_h < 0:
+        return None
+    if cull:
+        margin = obj.getDefaultedFloat("pbrt_instancecullmargin", now, [0.0])[0]
+        min_pixels = obj.getDefaultedFloat("pbrt_instancecullsize", now, [0.0])[0]
+    if lod:
+        lod_size = obj.getDefaultedFloat("pbrt_instancelodsize", now, [256.0])[0]
+    if cull or lod:
+        instancer_xform = obj_node.worldTransformAtTime(now)
+
+    points = array.array("i")
+    prototypes = []
+    xforms = []
+    usage = collections.OrderedDict()
+    lod_usage = collections.Counter()
+    culled = 0
+    for pt, prototype in enumerate(point_prototypes):
+        if not prototype:
+            continue
+        if cull or lod:
+            instance_geo = prototype
+            if hybrid_instances is not None:
+                prototype_info = hybrid_instances.prototypes.get(prototype)
+                if prototype_info is not None:
+                    instance_geo = prototype_info[0]
+            sphere = _prototype_sphere(instance_geo, now)
+        else:
+            sphere = None
+        if sphere is not None:
+            xform = hou.Matrix4(geo.value(xform_h, pt)) * instancer_xform
+            center = sphere[0] * xform
+            radius = sphere[1] * _max_scale(xform)
+            if cull and _culled(camera_view, center, radius, margin, min_pixels):
+                culled += 1
+                continue
+            # Hybrid prototypes bind a material to their geometry so only
+            # plain prototypes are swapped for their variants.
+            if lod and prototype == instance_geo:
+                variants = _lod_variants(instance_geo)
+                if len(variants) > 1:
+                    level = _lod_level(
+                        camera_view.sphere_pixel_size(center, radius), lod_size
+                    )
+                    level = min(level, len(variants) - 1)
+                    prototype = variants[level]
+                    lod_usage[level] += 1
+        nested = _flattened_instances(prototype, now)
+        if nested is None:
+            points.append(pt)
+            prototypes.append(prototype)
+            xforms.append(None)
+            usage[prototype] = usage.get(prototype, 0) + 1
+            continue
+        pt_xform = hou.Matrix4(geo.value(xform_h, pt))
+        for leaf, leaf_xform in nested:
+            points.append(pt)
+            prototypes.append(leaf)
+            xforms.append((leaf_xform * pt_xform).asTuple())
+            usage[leaf] = usage.get(leaf, 0) + 1
+        scene_state.stats.add("Flattened nested instances", len(nested))
+
+    scene_state.stats.add("Fast instances", len(points))
+    if culled:
+        scene_state.stats.add("Culled fast instances", culled)
+    for level, count in lod_usage.iteritems():
+        scene_state.stats.add("Fast instances at LOD %i" % level, count)
+    fast_instances = _FastInstances(points, prototypes, xforms, usage)
+    scene_state.fast_instancers[name] = fast_instances
+    return fast_instances
+
+
+def wrangle_fast_instances(obj, now, shutter_range=None):
+    """Output instanced geoemtry defined by fast instancing
+
+    If a shutter_range is given and the pbrt_velocityblur property is
+    enabled, the v and w point attributes are used to move each instance
+    over the shutter instead of evaluating the instancer at other times.
+    """
 
     # We need hou.Node handles so we can resolve relative paths
     # since soho does not do this.
@@ -102,7 +535,6 @@ def wrangle_fast_instances(obj, now):
 
     pt_attribs = (
         "geo:pointxform",
-        "instance",
         # NOTE: Materials can not be applied to ObjectInstances
         # ( or setting material params (overrides) for that matter
         # See Excersise B.2 in 'The Book'
@@ -111,6 +543,8 @@ def wrangle_fast_instances(obj, now):
         # works on the base instance defintion
         # 'shop_materialpath',
         # 'material_override',
+        # These are instead handled by hybrid instancing which binds them
+        # within per material prototypes, see get_hybrid_instances()
     )
 
     # NOTE: Homogenous volumes work when applied to a ObjectBegin/End however
@@ -127,28 +561,122 @@ def wrangle_fast_instances(obj, now):
         api.Comment("Can not find instance xform attribs, skipping")
         return
 
-    instancepath = []
-    obj.evalString("instancepath", now, instancepath)
-    instance_node = obj_node.node(instancepath[0])
-    if instance_node is not None:
-        default_instance_geo = instance_node.path()
-    else:
-        default_instance_geo = ""
+    fast_instances = get_fast_instances(obj, now)
+    if fast_instances is None:
+        api.Comment("Can not resolve fast instances, skipping")
+        return
 
-    for pt in xrange(num_pts):
-        instance_geo = default_instance_geo
-        if "instance" in pt_attrib_map:
-            pt_instance_geo = geo.value(pt_attrib_map["instance"], pt)[0]
-            pt_instance_node = sop_node.node(pt_instance_geo)
-            if pt_instance_node is not None:
-                instance_geo = pt_instance_node.path()
+    velocities = {}
+    if (
+        shutter_range is not None
+        and obj.getDefaultedInt("pbrt_velocityblur", now, [0])[0]
+    ):
+        velocities = _fetch_point_attribs(sop, ("v", "w", "P"), now)
+    v_values = velocities.get("v")
+    w_values = velocities.get("w")
+    pivots = velocities.get("P")
+    motion = v_values is not None or w_values is not None
+    if motion:
+        open_time = shutter_range.open - now
+        close_time = shutter_range.close - now
+        scene_state.stats.add("Velocity blurred fast instancers")
 
-        if not instance_geo:
-            continue
+    show_comments = obj.getDefaultedInt("pbrt_instancecomments", now, [1])[0]
+    block = _instance_block_template(show_comments, motion)
+    xform_h = pt_attrib_map["geo:pointxform"]
 
-        with api.AttributeBlock():
-            api.Comment("%s:[%i]" % (sop, pt))
-            xform = geo.value(pt_attrib_map["geo:pointxform"], pt)
-            api.ConcatTransform(xform)
-            api.ObjectInstance(instance_geo)
+    # Rather than many api calls per point, the blocks are formatted from a
+    # template and written out in chunks.
+    chunk = []
+    for pt, prototype, xform in itertools.izip(
+        fast_instances.points, fast_instances.prototypes, fast_instances.xforms
+    ):
+        if xform is None:
+            xform = geo.value(xform_h, pt)
+        if motion:
+            v = v_values[pt] if v_values is not None else None
+            w = w_values[pt] if w_values is not None else None
+            pivot = pivots[pt] if pivots is not None else None
+            xform_open = _velocity_xform(xform, open_time, v, w, pivot)
+            xform_close = _velocity_xform(xform, close_time, v, w, pivot)
+            chunk.append(
+                block.format(
+                    comment="%s:[%i]" % (sop, pt),
+                    xform_open=soho.arrayToString("[ ", xform_open, " ]"),
+                    xform_close=soho.arrayToString("[ ", xform_close, " ]"),
+                    instance=prototype,
+                )
+            )
+        else:
+            chunk.append(
+                block.format(
+                    comment="%s:[%i]" % (sop, pt),
+                    xform=soho.arrayToString("[ ", xform, " ]"),
+                    instance=prototype,
+                )
+            )
+        if len(chunk) >= 4096:
+            sys.stdout.write("".join(chunk))
+            del chunk[:]
+    sys.stdout.write("".join(chunk))
     return
+
+
+def _instance_block_template(comment=True, motion=False):
+    """Returns a format string of an ObjectInstance's AttributeBlock
+
+    The template is built from the api calls at the current indentation with
+    {comment}, {xform} and {instance} fields to be filled in. If motion is
+    True, {xform_open} and {xform_close} are used instead of {xform} for
+    the transforms at the shutter's open and close.
+    """
+    with api.CaptureBlock() as output:
+        with api.AttributeBlock():
+            if comment:
+                api.Comment("COMMENT")
+            if motion:
+                api.ActiveTransform("StartTime")
+                api.ConcatTransform([0])
+                api.ActiveTransform("EndTime")
+                api.ConcatTransform([1])
+                api.ActiveTransform("All")
+            else:
+                api.ConcatTransform([0])
+            api.ObjectInstance("INSTANCE")
+    template = output.getvalue().replace("{", "{{").replace("}", "}}")
+    template = template.replace("COMMENT", "{comment}")
+    if motion:
+        template = template.replace("[ 0 ]", "{xform_open}")
+        template = template.replace("[ 1 ]", "{xform_close}")
+    else:
+        template = template.replace("[ 0 ]", "{xform}")
+    template = template.replace("INSTANCE", "{instance}")
+    return template
+
+
+def _velocity_xform(xform, time, v=None, w=None, pivot=None):
+    """Moves an instance transform by its velocities over a period of time
+
+    Args:
+        xform (tuple): The instance's transform
+        time (float): Seconds from the instance's transform's time
+        v (tuple): Velocity in units per second (Optional)
+        w (tuple): Angular velocity, as an axis scaled by radians per
+                   second, rotating around the pivot (Optional)
+        pivot (tuple): Position the angular velocity rotates around
+    Returns: tuple of the moved Matrix4
+    """
+    xform = hou.Matrix4(xform)
+    if w is not None and pivot is not None:
+        axis = hou.Vector3(w)
+        angle = axis.length() * time
+        if angle:
+            xform = (
+                xform
+                * hou.hmath.buildTranslate(hou.Vector3(pivot) * -1.0)
+                * hou.hmath.buildRotateAboutAxis(axis, math.degrees(angle))
+                * hou.hmath.buildTranslate(hou.Vector3(pivot))
+            )
+    if v is not None:
+        xform = xform * hou.hmath.buildTranslate(hou.Vector3(v) * time)
+    return xform.asTuple()
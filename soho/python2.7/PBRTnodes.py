@@ -9,6 +9,8 @@ import collections
 import hou
 import soho
 
+from PBRTstate import scene_state
+
 
 class HouParmException(Exception):
     pass
@@ -58,6 +60,8 @@ class PBRTParam(object):
     type_synonyms = {"point": "point3", "vector": "vector3", "color": "rgb"}
     spectrum_types = set(["color", "rgb", "blackbody", "xyz", "spectrum"])
 
+    __slots__ = ("type", "param_type", "name", "_value")
+
     def __init__(self, param_type, param_name, param_value=None):
         """
         Args:
@@ -68,26 +72,12 @@ class PBRTParam(object):
         Raises:
             TypeError: If param_type does not match a known pbrt_type
         """
-        param_type = self.type_synonyms.get(param_type, param_type)
-        if param_type not in self.pbrt_types:
+        try:
+            self.param_type, self.type = _param_types[param_type]
+        except KeyError:
             raise TypeError("%s not a known PBRT type" % param_type)
-
-        if param_type == "spectrum" and isinstance(param_value, basestring):
-            # for convience these might either be a file path or an array
-            # of wavelengths/values. Here we'll convert a string representation
-            # of the array to an actual array if it
-            try:
-                param_value = eval(param_value, {}, {})
-            except:  # noqa: E722
-                # Be aggressive and catch anything
-                pass
-
-        if param_type in self.spectrum_types:
-            self.type = "spectrum"
-        else:
-            self.type = param_type
-        self.param_type = param_type
         self.name = param_name
+        # Spectrum strings are left as is until the value is needed, see value
         self._value = param_value if param_value is not None else []
 
     def __str__(self):
@@ -119,6 +109,8 @@ class PBRTParam(object):
     @property
     def value(self):
         """The value of the param, converted from python values to pbrt values"""
+        if self.param_type == "spectrum" and isinstance(self._value, basestring):
+            self._value = _parse_spectrum(self._value)
         if isinstance(self._value, types.GeneratorType):
             v = self._value
         elif not isinstance(self._value, (list, tuple, array.array)):
@@ -143,6 +135,38 @@ class PBRTParam(object):
         return soho.printArray('"%s" [ ' % self.type_name, self.value, " ]")
 
 
+def _parse_spectrum(value):
+    """Converts a string representation of a spectrum array to a list
+
+    For convience spectrums might either be a file path or an array of
+    wavelengths/values, file paths are returned unchanged.
+    """
+    try:
+        return eval(value, {}, {})
+    except:  # noqa: E722
+        # Be aggressive and catch anything
+        return value
+
+
+# Maps each accepted type name, including synonyms, to the interned
+# (param_type, type) pair of a PBRTParam so construction is a single lookup.
+_param_types = {}
+for _type_name in PBRTParam.pbrt_types + tuple(PBRTParam.type_synonyms):
+    _param_type = intern(PBRTParam.type_synonyms.get(_type_name, _type_name))
+    _param_types[_type_name] = (
+        _param_type,
+        "spectrum" if _param_type in PBRTParam.spectrum_types else _param_type,
+    )
+del _type_name, _param_type
+
+
+def _param_key(param_type, param_name):
+    """The (type, name) a PBRTParam of param_type and param_name compares by"""
+    if param_type in _param_types:
+        param_type = _param_types[param_type][1]
+    return (param_type, param_name)
+
+
 class ParamSet(collections.MutableSet):
     """Represents a collection of PBRTParams
 
@@ -153,21 +177,38 @@ class ParamSet(collections.MutableSet):
     paramset |= other_paramset
     are valid, in the case above the operation is similar to and add,
     not a replace.
+
+    Params are stored by their (type, name) and are always iterated in
+    sorted order so the output is the same between runs. Copying a ParamSet
+    shares the params until either copy is modified.
     """
 
     def __init__(self, iterable=None):
-        self._data = set()
+        self._data = {}
+        self._shared = False
         if not iterable:
             return
+        if isinstance(iterable, ParamSet):
+            # Copy on write, see _own()
+            self._data = iterable._data
+            self._shared = iterable._shared = True
+            return
         self |= iterable
 
+    def _own(self):
+        """Copies the shared params before they are modified"""
+        if self._shared:
+            self._data = dict(self._data)
+            self._shared = False
+
     def __contains__(self, item):
-        return item in self._data
+        if not isinstance(item, PBRTParam):
+            return False
+        return (item.type, item.name) in self._data
 
     def __iter__(self):
-        # TODO: Sort based on type/name?
-        for v in self._data:
-            yield v
+        for key in sorted(self._data):
+            yield self._data[key]
 
     def __len__(self):
         return len(self._data)
@@ -177,36 +218,62 @@ class ParamSet(collections.MutableSet):
 
     def add(self, param):
         """Add a param if it does not already exist"""
-        self._data.add(param)
+        key = (param.type, param.name)
+        if key not in self._data:
+            self._own()
+            self._data[key] = param
 
     def discard(self, param):
         """Remove a param if it exists, no exception if it does not"""
-        self._data.discard(param)
+        key = (param.type, param.name)
+        if key in self._data:
+            self._own()
+            del self._data[key]
 
     def replace(self, param):
-        """Remove a param then add the new one"""
-        self.discard(param)
-        self.add(param)
+        """Add a param, replacing any existing one of the same type and name"""
+        self._own()
+        self._data[(param.type, param.name)] = param
 
     def find_param(self, ptype, name):
         """Find a return a PBRTParam of ptype and name if in the ParamSet"""
-        param_to_find = PBRTParam(ptype, name)
-        for p in self._data:
-            if p == param_to_find:
-                return p
-        return None
+        return self._data.get(_param_key(ptype, name))
 
     def update(self, other):
         """Update (and replace) this ParamSet with another ParamSet"""
         if not other:
             return
+        self._own()
         for o in other:
-            self.replace(o)
+            self._data[(o.type, o.name)] = o
+
+
+def canonical_override(override_str):
+    """Returns a canonical form of a material_override string
+
+    Overrides with the same values but written in a different order compare
+    equal in their canonical form.
+    """
+    try:
+        override = eval(override_str, {}, {})
+    except:  # noqa: E722
+        return override_str
+    if not isinstance(override, dict):
+        return override_str
+    return repr(sorted(override.items()))
 
 
 def get_directive_from_nodetype(node_type):
     """Get the 'directive' of a Houdini PBRT VOP
 
+    See _directive_from_nodetype(), the result is cached per node type.
+    """
+    return node_type_info(node_type).directive
+
+
+def _directive_from_nodetype(node_type):
+    """Get the 'directive' of a Houdini PBRT VOP
+
     The directive will typically be something like 'texture', 'material', etc.
     These coorespond to the api calls. The type of directive the not represents
     is first searched for in the userInfo of the node's definition. If the
@@ -249,6 +316,70 @@ def get_directive_from_nodetype(node_type):
     return directive
 
 
+ParmInfo = collections.namedtuple(
+    "ParmInfo", ["parm_type", "naming_scheme", "pbrt_type", "meta", "force"]
+)
+
+
+class NodeTypeInfo(object):
+    """Metadata of a PBRT VOP type, shared by all nodes of that type
+
+    Reading a type's definition, userInfo and parm templates is slow
+    compared to evaluating a parm, so these are only read once per type.
+
+    Args:
+        node_type (hou.NodeType): Type to gather the metadata of
+    """
+
+    def __init__(self, node_type):
+        self.directive = _directive_from_nodetype(node_type)
+        self.function_name = None
+        definition = node_type.definition()
+        if definition is not None:
+            function_name = definition.sections().get("FunctionName")
+            if function_name is not None:
+                self.function_name = function_name.contents()
+        self.parms = {}
+
+    def parm_info(self, parm_tuple):
+        """Returns the ParmInfo of the type's parm matching the hou.ParmTuple
+
+        Spare parms belong to a single node rather than the type, so they
+        are never cached.
+        """
+        if parm_tuple.isSpare():
+            return _parm_info(parm_tuple)
+        name = parm_tuple.name()
+        info = self.parms.get(name)
+        if info is None:
+            info = _parm_info(parm_tuple)
+            self.parms[name] = info
+        return info
+
+
+def _parm_info(parm_tuple):
+    """Reads the ParmInfo of a hou.ParmTuple from its parm template"""
+    parm_tmpl = parm_tuple.parmTemplate()
+    tags = parm_tmpl.tags()
+    return ParmInfo(
+        parm_tmpl.type(),
+        parm_tmpl.namingScheme(),
+        tags.get("pbrt.type"),
+        "pbrt.meta" in tags,
+        "pbrt.force" in tags,
+    )
+
+
+def node_type_info(node_type):
+    """Returns the NodeTypeInfo of a hou.NodeType, cached per render"""
+    key = node_type.nameWithCategory()
+    info = scene_state.node_types.get(key)
+    if info is None:
+        info = NodeTypeInfo(node_type)
+        scene_state.node_types[key] = info
+    return info
+
+
 class BaseNode(object):
     """Base representation of a PBRT VOP node
 
@@ -272,12 +403,13 @@ class BaseNode(object):
         else:
             return None
 
-        directive = get_directive_from_nodetype(node.type())
+        type_info = node_type_info(node.type())
+        directive = type_info.directive
 
         if directive is None:
             return None
 
-        dtype = node.type().definition().sections()["FunctionName"].contents()
+        dtype = type_info.function_name
 
         if directive == "material":
             return MaterialNode(node, ignore_defaults)
@@ -297,12 +429,9 @@ class BaseNode(object):
         else:
             raise hou.TypeError("%s is unknown type" % node)
 
-        # Since we rely on hidden and disabled states for which parms
-        # to export, we need to ensure these are set
-        self.node.updateParmStates()
-
         self.ignore_defaults = ignore_defaults
-        self.directive = get_directive_from_nodetype(node.type())
+        self.type_info = node_type_info(node.type())
+        self.directive = self.type_info.directive
         self.path_prefix = ""
         self.path_suffix = ""
         self.override_cache = {}
@@ -317,7 +446,7 @@ class BaseNode(object):
         # I'm not sure why that is the case but I suspect its due to the
         # shopclerk althought further experiments are needed.
         # For now we'll brute force it
-        return self.node.type().definition().sections()["FunctionName"].contents()
+        return self.type_info.function_name
 
     @property
     def path(self):
@@ -338,10 +467,10 @@ class BaseNode(object):
     def get_used_parms(self):
         parms = {}
         for parm_tup in self.node.parmTuples():
-            parm_tags = parm_tup.parmTemplate().tags()
+            parm_info = self.type_info.parm_info(parm_tup)
             parm_name = parm_tup.name()
 
-            if "pbrt.meta" in parm_tags:
+            if parm_info.meta:
                 # Ignore meta parameters that are used to
                 # control the UI
                 continue
@@ -355,11 +484,7 @@ class BaseNode(object):
             if parm_tup.isDisabled() or parm_tup.isHidden():
                 continue
 
-            if (
-                parm_tup.isAtDefault()
-                and self.ignore_defaults
-                and "pbrt.force" not in parm_tags
-            ):
+            if parm_tup.isAtDefault() and self.ignore_defaults and not parm_info.force:
                 # If the parm is at its default but has an input
                 # then consider it used, otherwise skip it...
                 # unless we have metadata to says force its output
@@ -369,8 +494,40 @@ class BaseNode(object):
 
         return parms
 
+    def _translation(self):
+        """Returns the cached (directive_type, ParamSet) of the node
+
+        Translating a node evaluates all of its parms, and the same nodes are
+        translated many times during a render, for example a medium for
+        every object using it. The translation is cached by the node and
+        anything else affecting it for the duration of a render.
+        """
+        key = (
+            type(self),
+            self.path,
+            self.ignore_defaults,
+            self.path_prefix,
+            self.path_suffix,
+        )
+        translation = scene_state.node_translations.get(key)
+        if translation is not None:
+            scene_state.stats.add("Node translation cache hits")
+            return translation
+        scene_state.stats.add("Node translation cache misses")
+
+        # Since we rely on hidden and disabled states for which parms
+        # to export, we need to ensure these are set
+        self.node.updateParmStates()
+        translation = (self.directive_type, self._build_paramset())
+        scene_state.node_translations[key] = translation
+        return translation
+
     @property
     def paramset(self):
+        # The cached ParamSet is shared so a copy is returned to be modified
+        return ParamSet(self._translation()[1])
+
+    def _build_paramset(self):
         params = ParamSet()
         hou_parms = self.get_used_parms()
         for parm_name in sorted(hou_parms):
@@ -385,7 +542,8 @@ class BaseNode(object):
 
     @property
     def type_and_paramset(self):
-        return (self.directive_type, self.paramset)
+        directive_type, paramset = self._translation()
+        return (directive_type, ParamSet(paramset))
 
     def pbrt_parm_name(self, name):
         return name
@@ -550,9 +708,9 @@ class BaseNode(object):
         # Spectrum is another special case in that its a rgb type, but if it
         # has an input of pbrt_spectrum type then extra options are available.
 
-        parm_tmpl = parm.parmTemplate()
-        parm_type = parm_tmpl.type()
-        parm_scheme = parm_tmpl.namingScheme()
+        parm_info = node_type_info(parm.node().type()).parm_info(parm)
+        parm_type = parm_info.parm_type
+        parm_scheme = parm_info.naming_scheme
         # Assuming there will only be a single coshader "node"
         # per parameter.
         coshaders = parm.node().coshaderNodes(parm_name)
@@ -603,10 +761,8 @@ class BaseNode(object):
             pbrt_type = "texture"
             pbrt_value = coshader.full_name
         # PBRT: point*/vector*/normal
-        elif (
-            parm_type == hou.parmTemplateType.Float and "pbrt.type" in parm_tmpl.tags()
-        ):
-            pbrt_type = parm_tmpl.tags()["pbrt.type"]
+        elif parm_type == hou.parmTemplateType.Float and parm_info.pbrt_type:
+            pbrt_type = parm_info.pbrt_type
             pbrt_value = parm.eval()
         # PBRT: float (sometimes a float is just a float)
         elif parm_type == hou.parmTemplateType.Float:
@@ -624,8 +780,7 @@ class BaseNode(object):
 
 
 class SpectrumNode(BaseNode):
-    @property
-    def paramset(self):
+    def _build_paramset(self):
         params = ParamSet()
 
         spectrum_type = self.node.parm("type").evalAsString()
@@ -681,9 +836,8 @@ class MaterialNode(BaseNode):
     def output_type(self):
         return "string type"
 
-    @property
-    def paramset(self):
-        params = super(MaterialNode, self).paramset
+    def _build_paramset(self):
+        params = super(MaterialNode, self)._build_paramset()
 
         # Materials might inputs that don't exist as parms
         # (bumpmap float textures, and materials for example)
@@ -731,7 +885,7 @@ class TextureNode(MaterialNode):
             if parm_name == "signature":
                 continue
             # We could also check for name == texture_space
-            if parm.parmTemplate().tags().get("pbrt.type") == "space":
+            if self.type_info.parm_info(parm).pbrt_type == "space":
                 continue
             # Foolproof way:
             # re.sub('_%s$' % signature, '', parm_name)
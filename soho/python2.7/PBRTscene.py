@@ -2,14 +2,28 @@ from __future__ import print_function, division, absolute_import
 
 import os
 import time
+import collections
 
+import hou
 import soho
 from sohog import SohoGeometry
 
 import PBRTapi as api
+import PBRTcache
 from PBRTwranglers import *  # noqa: F403
+from PBRTwranglers import (
+    geo_parm_selection,
+    get_transform,
+    output_xform,
+    output_full_pt_instance_materials,
+    output_override_material,
+)
 from PBRTnodes import BaseNode
-from PBRTinstancing import find_referenced_instances, get_full_instance_info
+from PBRTinstancing import (
+    get_full_instance_info,
+    get_hybrid_instances,
+    get_fast_instances,
+)
 from PBRTstate import scene_state
 
 # Ignore the various linting errors due to the import *
@@ -47,20 +61,11 @@ def output_materials(obj, wrangler, now):
         for shop in shop_materialpaths:
             wrangle_shading_network(shop)
 
-    # TODO / CONSIDER, for very large number of instance objects it might speed things
-    #   up to cache the fact we've already visited a source network.
-    #   Store in scenestate?
-    #   (This will avoid much of the below on a per instance basis)
+    # Each point of a full instancer is its own object, so only the materials
+    # of the points which are output are defined.
     instance_info = get_full_instance_info(obj, now)
-    if instance_info is None:
-        return
-    attrib_h = instance_info.gdp.attribute("geo:point", "shop_materialpath")
-    if attrib_h >= 0:
-        shop_materialpaths = instance_info.gdp.attribProperty(
-            attrib_h, "geo:allstrings"
-        )
-        for shop in shop_materialpaths:
-            wrangle_shading_network(shop)
+    if instance_info is not None:
+        output_full_pt_instance_materials(instance_info)
     return
 
 
@@ -94,34 +99,268 @@ def output_mediums(obj, wrangler, now):
 
 
 def output_instances(obj, wrangler, now):
-    """Define any instances referenced by the Soho Object
+    """Define the instances used by the Soho Object's fast instances
 
-    This method takes an object and based on its parms and point attributes
-    will iterate over any found instances and output them so they can be
-    later referenced.
+    Instances are only defined once they are used by at least one point, so
+    instanced geometry which has been culled or is not referenced after
+    resolving the instance attribute is skipped entirely. This is called
+    just before the object itself is output, which is also when the
+    instanced geometry's materials and mediums are output.
     """
 
-    for instance in find_referenced_instances(obj):
-        if instance in scene_state.instanced_geo:
+    fast_instances = get_fast_instances(obj, now)
+    if fast_instances is None:
+        return
+    hybrid_instances = get_hybrid_instances(obj, now)
+
+    for prototype, count in fast_instances.usage.iteritems():
+        scene_state.stats.add("Instance prototype references", count)
+        if prototype in scene_state.instanced_geo:
             # If we've already emitted this reference geometry
             # then continue so we don't have duplicate definitions
             # this can happen if multiple instance nodes reference
             # the same geo
             continue
-        scene_state.instanced_geo.add(instance)
+        scene_state.instanced_geo.add(prototype)
+        scene_state.stats.add("Instance prototypes")
+
+        if hybrid_instances is not None and prototype in hybrid_instances.prototypes:
+            output_hybrid_prototype(
+                prototype, hybrid_instances.prototypes[prototype], wrangler, now
+            )
+            continue
 
         # Since a referenced geo might not be displayed, output its
         # mediums if any.
         # TODO this works but is a bit magic, rethink this and see if there
         # is a better approach.
-        instance_obj = soho.getObject(instance)
+        instance_obj = soho.getObject(prototype)
         output_materials(instance_obj, wrangler, now)
         output_mediums(instance_obj, wrangler, now)
 
-        with api.ObjectBlock(instance), api.AttributeBlock():
-            soho_obj = soho.getObject(instance)
-            wrangle_obj(soho_obj, wrangler, now)
+        with api.ObjectBlock(prototype), api.AttributeBlock():
+            wrangle_obj(instance_obj, wrangler, now)
         print()
+    scene_state.stats.add_ratio(
+        "Instance prototype reuse",
+        "Instance prototypes",
+        "Instance prototype references",
+    )
+    return
+
+
+def output_hybrid_prototype(prototype, prototype_info, wrangler, now):
+    """Define a hybrid instance's prototype
+
+    Hybrid instance prototypes bind their material before the instanced
+    object, which is told to not output its own. The material is defined
+    along with the prototype, so materials of unused prototypes are skipped.
+    As with other prototypes, the instanced object's own materials and
+    mediums are output as it might not be displayed.
+    """
+    instance, shop, override_str = prototype_info
+    instance_obj = soho.getObject(instance)
+    output_materials(instance_obj, wrangler, now)
+    output_mediums(instance_obj, wrangler, now)
+
+    wrangle_shading_network(shop)
+    if override_str:
+        material = output_override_material(shop, override_str)
+    else:
+        material = shop if shop in scene_state.shading_nodes else None
+
+    with api.ObjectBlock(prototype), api.AttributeBlock():
+        if material:
+            api.NamedMaterial(material)
+        wrangle_obj(instance_obj, wrangler, now, ignore_shop=material is not None)
+    print()
+    return
+
+
+def object_bounds(obj, now):
+    """Returns the SOP bounds, world transform and geo for a Soho Object
+
+    None is returned if the object's bounds don't represent what will be
+    output, such as fast instancers and included files.
+    """
+    ptinstance = obj.getDefaultedInt("ptinstance", now, [0])[0]
+    if ptinstance == 2:
+        return None
+    if obj.getDefaultedString("instancepath", now, [""])[0]:
+        return None
+    if obj.getDefaultedString("pbrt_include", now, [""])[0]:
+        return None
+
+    soppath = []
+    if not obj.evalString("object:soppath", now, soppath):
+        return None
+    node = hou.node(soppath[0])
+    if node is None or node.type().category() != hou.sopNodeTypeCategory():
+        return None
+    gdp = node.geometryAtFrame(hou.timeToFrame(now))
+    if gdp is None:
+        return None
+
+    xform = get_transform(obj, now)
+    if xform is None:
+        return None
+    return gdp.boundingBox(), hou.Matrix4(xform), gdp
+
+
+def cull_objects(cam, objects, now):
+    """Remove objects outside of the camera's view or past a max distance
+
+    The view frustum is expanded by the pbrt_cullmargin so objects just off
+    screen, which may still be seen in reflections or cast shadows, are kept.
+    """
+    if not cam.getDefaultedInt("pbrt_cull", now, [0])[0]:
+        return objects
+    view = scene_state.camera_view
+    if view is None:
+        return objects
+    margin = cam.getDefaultedFloat("pbrt_cullmargin", now, [0.0])[0]
+    max_distance = cam.getDefaultedFloat("pbrt_cullmaxdistance", now, [0.0])[0]
+
+    visible = []
+    for obj in objects:
+        bounds = object_bounds(obj, now)
+        if bounds is None:
+            visible.append(obj)
+            continue
+        bbox, xform, gdp = bounds
+        if view.in_frustum(bbox, xform, margin) and (
+            max_distance <= 0 or view.distance(bbox, xform) <= max_distance
+        ):
+            visible.append(obj)
+            continue
+        # An estimate of the in memory size of the culled points and indices
+        culled_bytes = 12 * gdp.intrinsicValue("pointcount")
+        culled_bytes += 4 * gdp.intrinsicValue("vertexcount")
+        scene_state.stats.add("Culled objects")
+        scene_state.stats.add("Culled geometry bytes (estimated)", culled_bytes)
+    return visible
+
+
+def autoinstance_candidates(cam, objects, now):
+    """Returns the objects whose geometry is shared with another
+
+    Objects are grouped by a hash of their SOP geometry, only these objects
+    can possibly produce identical output. Hashing serializes the geometry,
+    so objects are first grouped by their point, primitive and vertex counts
+    and only those which share their counts with another object are hashed.
+
+    Returns: A dict of object names to their geometry's hash
+    """
+    if not cam.getDefaultedInt("pbrt_autoinstance", now, [0])[0]:
+        return {}
+
+    objects_by_counts = collections.defaultdict(list)
+    for obj in objects:
+        # Instancers and full instances may define per point materials,
+        # which would be scoped to the first prototype.
+        if obj.getDefaultedInt("ptinstance", now, [0])[0]:
+            continue
+        if obj.getDefaultedString("instancepath", now, [""])[0]:
+            continue
+        if ":" in obj.getName():
+            continue
+        # Alpha textures are defined on first use, and includes could define
+        # anything, which would place them within the first prototype only.
+        if obj.getDefaultedString("pbrt_alpha_texture", now, [""])[0]:
+            continue
+        if obj.getDefaultedString("pbrt_shadowalpha_texture", now, [""])[0]:
+            continue
+        if obj.getDefaultedString("pbrt_include", now, [""])[0]:
+            continue
+        # The output of these depends on the object's transform
+        if obj.getDefaultedInt("pbrt_lod", now, [0])[0]:
+            continue
+        if obj.getDefaultedInt("pbrt_subdauto", now, [0])[0]:
+            continue
+        soppath = []
+        if not obj.evalString("object:soppath", now, soppath):
+            continue
+        node = hou.node(soppath[0])
+        if node is None or node.type().category() != hou.sopNodeTypeCategory():
+            continue
+        # SopNode.geometry() is evaluated at the current time rather than now
+        gdp = node.geometryAtFrame(hou.timeToFrame(now))
+        if gdp is None:
+            continue
+        counts = (
+            gdp.intrinsicValue("pointcount"),
+            gdp.intrinsicValue("primitivecount"),
+            gdp.intrinsicValue("vertexcount"),
+        )
+        objects_by_counts[counts].append((obj.getName(), node, gdp))
+
+    # Objects using the same SOP only need to be hashed once
+    hashes = {}
+    objects_by_geo = collections.defaultdict(list)
+    for grouped in objects_by_counts.itervalues():
+        if len(grouped) < 2:
+            continue
+        for name, node, gdp in grouped:
+            key = PBRTcache.sop_key(node, now)
+            if key not in hashes:
+                scene_state.stats.add("Auto instance geometry hashes")
+                hashes[key] = PBRTcache.geo_hash(gdp)
+            objects_by_geo[hashes[key]].append(name)
+
+    candidates = {}
+    for geo_key, names in objects_by_geo.iteritems():
+        if len(names) > 1:
+            candidates.update((name, geo_key) for name in names)
+    return candidates
+
+
+def autoinstance_key(obj, geo_key, now):
+    """Returns a key for the object definition output by output_autoinstance
+
+    The key is the object's geometry along with the properties which affect
+    how it is output, such as its material and mediums, so objects with the
+    same key output identical definitions.
+
+    Args:
+        obj (soho.SohoObject): Object to key
+        geo_key (str): Hash of the object's SOP geometry
+        now (float): Time to evaluate the properties at
+    Returns: tuple
+    """
+    properties = obj.evaluate(geo_parm_selection(), now)
+    # The geometry is identified by geo_key rather than by where it is from
+    properties.pop("object:soppath", None)
+    return (geo_key,) + tuple(
+        (name, tuple(parm.Value)) for name, parm in sorted(properties.iteritems())
+    )
+
+
+def output_autoinstance(obj, wrangler, now, geo_key):
+    """Output an object as an ObjectInstance of a shared prototype
+
+    The first object with a given autoinstance_key outputs its geometry,
+    without its transform, as an object definition. All of them are then
+    output as an ObjectInstance of it.
+    """
+    key = autoinstance_key(obj, geo_key, now)
+    scene_state.stats.add("Auto instanced objects")
+    if key in scene_state.autoinstance_prototypes:
+        prototype = scene_state.autoinstance_prototypes[key]
+    else:
+        prototype = "%s:autoinstance" % obj.getName()
+        scene_state.autoinstance_prototypes[key] = prototype
+        scene_state.stats.add("Auto instance prototypes")
+        with api.ObjectBlock(prototype):
+            wrangle_obj(obj, wrangler, now, ignore_xform=True)
+    scene_state.stats.add_ratio(
+        "Auto instance deduplication",
+        "Auto instance prototypes",
+        "Auto instanced objects",
+    )
+
+    with api.AttributeBlock():
+        output_xform(obj, now)
+        api.ObjectInstance(prototype)
     return
 
 
@@ -150,6 +389,8 @@ def footer(start_time):  # pragma: no coverage
     if "SOHO_PBRT_NO_HEADER" in os.environ:
         return
     export_time = time.time() - start_time
+    for line in scene_state.stats.lines():
+        api.Comment(line)
     api.Comment("Total export time %0.02f seconds" % export_time)
 
 
@@ -192,6 +433,8 @@ def render(cam, now):
 
     output_transform_times(cam, now)
 
+    objects = cull_objects(cam, list(soho.objectList("objlist:instance")), now)
+
     # We will stash the global exterior and interior values in case they need
     # to be compared against later.
     interior, exterior = output_mediums(cam, wrangler, now)
@@ -219,7 +462,7 @@ def render(cam, now):
     # Output Materials
     api.Comment("=" * 50)
     api.Comment("NamedMaterial Definitions")
-    for obj in soho.objectList("objlist:instance"):
+    for obj in objects:
         output_materials(obj, wrangler, now)
 
     print()
@@ -227,27 +470,27 @@ def render(cam, now):
     # Output NamedMediums
     api.Comment("=" * 50)
     api.Comment("NamedMedium Definitions")
-    for obj in soho.objectList("objlist:instance"):
+    for obj in objects:
         output_mediums(obj, wrangler, now)
 
     print()
 
-    # Output Object Instances for Fast Instancing
-    api.Comment("=" * 50)
-    api.Comment("Object Instance Definitions")
-    for obj in soho.objectList("objlist:instance"):
-        output_instances(obj, wrangler, now)
-
-    print()
-
     # Output Objects
     api.Comment("=" * 50)
     api.Comment("Object Definitions")
-    for obj in soho.objectList("objlist:instance"):
+    autoinstance_objs = autoinstance_candidates(cam, objects, now)
+    for obj in objects:
+        # Instances are defined outside of the object's block as
+        # ObjectBegin captures the current transform.
+        output_instances(obj, wrangler, now)
         api.Comment("-" * 50)
         api.Comment(obj.getName())
-        with api.AttributeBlock():
-            wrangle_obj(obj, wrangler, now)
+        if obj.getName() in autoinstance_objs:
+            geo_key = autoinstance_objs[obj.getName()]
+            output_autoinstance(obj, wrangler, now, geo_key)
+        else:
+            with api.AttributeBlock():
+                wrangle_obj(obj, wrangler, now)
         print()
 
     print()
@@ -289,18 +532,13 @@ def archive(now):
 
     print()
 
-    # Output Object Instances for Fast Instancing
-    api.Comment("=" * 50)
-    api.Comment("Object Instance Definitions")
-    for obj in soho.objectList("objlist:instance"):
-        output_instances(obj, wrangler, now)
-
-    print()
-
     # Output Objects
     api.Comment("=" * 50)
     api.Comment("Object Definitions")
     for obj in soho.objectList("objlist:instance"):
+        # Instances are defined outside of the object's block as
+        # ObjectBegin captures the current transform.
+        output_instances(obj, wrangler, now)
         api.Comment("-" * 50)
         api.Comment(obj.getName())
         with api.AttributeBlock():
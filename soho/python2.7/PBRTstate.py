@@ -1,5 +1,9 @@
 from __future__ import print_function, division, absolute_import
 
+import math
+import itertools
+import collections
+
 import hou
 import soho
 
@@ -15,6 +19,179 @@ HVER_17_5 = (17, 5, 0)
 HVER_18 = (18, 0, 0)
 
 
+class ExportStats(object):
+    """Counters gathered during an export, reported in the scene's footer
+
+    Ratios are registered by name against two counters and are reported as
+    "numerator / denominator" along with a percentage.
+    """
+
+    def __init__(self):
+        self.counters = collections.Counter()
+        self.ratios = collections.OrderedDict()
+
+    def add(self, name, value=1):
+        """Increment the counter name by value"""
+        self.counters[name] += value
+
+    def set(self, name, value):
+        """Set the counter name to value"""
+        self.counters[name] = value
+
+    def add_ratio(self, name, numerator, denominator):
+        """Report the counter numerator as a ratio of the counter denominator"""
+        self.ratios[name] = (numerator, denominator)
+
+    def clear(self):
+        self.counters.clear()
+        self.ratios.clear()
+
+    def lines(self):
+        """Yields a human readable line for each counter and ratio"""
+        for name in sorted(self.counters):
+            yield "%s: %s" % (name, self.counters[name])
+        for name, (numerator, denominator) in self.ratios.iteritems():
+            num = self.counters[numerator]
+            den = self.counters[denominator]
+            if not den:
+                continue
+            yield "%s: %s / %s (%0.02f%%)" % (name, num, den, 100.0 * num / den)
+
+
+class CameraView(object):
+    """The render camera's view, used to measure geometry in screen space
+
+    Houdini cameras look down -Z, so all the camera space math below treats
+    -z as the depth.
+
+    Args:
+        cam_xform (hou.Matrix4): The camera's world transform
+        projection (str): pbrt camera type, one of perspective, orthographic
+                          or environment
+        res (list): Image resolution in pixels
+        window (list): Houdini's screen window as xmin, xmax, ymin, ymax
+                       where 0 to 1 covers the full frame
+        scale (float): focal / aperture for perspective cameras and
+                       1 / orthowidth for orthographic ones
+        aspectfix (float): Pixel aspect times the image aspect ratio
+    """
+
+    def __init__(self, cam_xform, projection, res, window, scale=1.0, aspectfix=1.0):
+        self.world_to_camera = cam_xform.inverted()
+        self.projection = projection
+        self.res = res
+        self.window = window
+        self.scale = scale
+        self.aspectfix = aspectfix
+        self.pixels_per_ndc = res[0] / float(window[1] - window[0])
+        self.planes = self._frustum_planes()
+        # The planes normalized so they give distances, for testing spheres
+        self.unit_planes = []
+        for a, b, c, d in self.planes:
+            length = math.sqrt(a * a + b * b + c * c)
+            self.unit_planes.append((a / length, b / length, c / length, d / length))
+
+    def _frustum_planes(self):
+        """Returns planes as (a, b, c, d) with a*x + b*y + c*z + d >= 0 inside"""
+        w = self.window
+        kx = self.scale
+        ky = self.scale * self.aspectfix
+        if self.projection == "perspective":
+            # ndc x = 0.5 + kx * x / -z, rearranged for each window edge
+            return (
+                (kx, 0.0, w[0] - 0.5, 0.0),
+                (-kx, 0.0, 0.5 - w[1], 0.0),
+                (0.0, ky, w[2] - 0.5, 0.0),
+                (0.0, -ky, 0.5 - w[3], 0.0),
+                (0.0, 0.0, -1.0, 0.0),
+            )
+        if self.projection == "orthographic":
+            # ndc x = 0.5 + kx * x
+            return (
+                (kx, 0.0, 0.0, 0.5 - w[0]),
+                (-kx, 0.0, 0.0, w[1] - 0.5),
+                (0.0, ky, 0.0, 0.5 - w[2]),
+                (0.0, -ky, 0.0, w[3] - 0.5),
+                (0.0, 0.0, -1.0, 0.0),
+            )
+        # Environment cameras see everything
+        return ()
+
+    def camera_bounds(self, bbox, xform, margin=0.0):
+        """Returns the min and max of the bbox once transformed to camera space
+
+        Args:
+            bbox (hou.BoundingBox): Object space bounds
+            xform (hou.Matrix4): Object to world transform
+            margin (float): Amount to expand the bounds by in world units
+        Returns: tuple of the min and max as lists
+        """
+        to_camera = xform * self.world_to_camera
+        corners = [
+            hou.Vector3(corner) * to_camera
+            for corner in itertools.product(*zip(bbox.minvec(), bbox.maxvec()))
+        ]
+        lo = [min(c[i] for c in corners) - margin for i in range(3)]
+        hi = [max(c[i] for c in corners) + margin for i in range(3)]
+        return lo, hi
+
+    def in_frustum(self, bbox, xform, margin=0.0):
+        """Whether any part of the bbox, expanded by margin, may be visible"""
+        lo, hi = self.camera_bounds(bbox, xform, margin)
+        corners = list(itertools.product(*zip(lo, hi)))
+        for a, b, c, d in self.planes:
+            if all(a * x + b * y + c * z + d < 0 for x, y, z in corners):
+                return False
+        return True
+
+    def sphere_in_frustum(self, center, radius):
+        """Whether any part of a world space sphere may be visible
+
+        Args:
+            center (hou.Vector3): World space center of the sphere
+            radius (float): Radius of the sphere
+        Returns: bool
+        """
+        x, y, z = center * self.world_to_camera
+        for a, b, c, d in self.unit_planes:
+            if a * x + b * y + c * z + d < -radius:
+                return False
+        return True
+
+    def sphere_pixel_size(self, center, radius):
+        """The size in pixels of a world space sphere's diameter"""
+        x, y, z = center * self.world_to_camera
+        if self.projection == "environment":
+            depth = math.sqrt(x * x + y * y + z * z) - radius
+        else:
+            depth = -z - radius
+        return self.pixel_size(2.0 * radius, depth)
+
+    def distance(self, bbox, xform):
+        """The distance from the camera to the nearest point of the bbox"""
+        lo, hi = self.camera_bounds(bbox, xform)
+        return math.sqrt(sum(max(a, 0.0, -b) ** 2 for a, b in zip(lo, hi)))
+
+    def pixel_size(self, length, depth):
+        """The number of pixels a length at the given depth spans"""
+        depth = max(depth, 1e-6)
+        if self.projection == "perspective":
+            return self.pixels_per_ndc * self.scale * length / depth
+        if self.projection == "orthographic":
+            return self.pixels_per_ndc * self.scale * length
+        return self.res[0] * length / (2.0 * math.pi * depth)
+
+    def projected_size(self, bbox, xform):
+        """The size in pixels of the bbox's diagonal at its nearest point"""
+        lo, hi = self.camera_bounds(bbox, xform)
+        diagonal = math.sqrt(sum((b - a) ** 2 for a, b in zip(lo, hi)))
+        if self.projection == "environment":
+            depth = self.distance(bbox, xform)
+        else:
+            depth = -hi[2]
+        return self.pixel_size(diagonal, depth)
+
+
 class PBRTState(object):
     """Holds the global state of the render session.
 
@@ -37,12 +214,56 @@ if gdp is not None:
         self.invalid_shading_nodes = set()
         self.medium_nodes = set()
         self.instanced_geo = set()
+        # Names of the prototypes defined for packed primitives
+        self.packed_prototypes = set()
+        # Nesting depth of ObjectBegin/ObjectEnd, pbrt does not allow nested
+        # object definitions.
+        self.object_depth = 0
+        # Maps an object's autoinstance_key to its auto instance prototype
+        self.autoinstance_prototypes = {}
         # We do not interior/exterior these directly but are handy as
         # a quick way of seeing if they are set at the camera/rop
         # level
         self.interior = None
         self.exterior = None
         self.tesselator = None
+        self.stats = ExportStats()
+        # The CameraView of the render camera, if known
+        self.camera_view = None
+        # Maps (base node path, relative path) to the resolved node path or
+        # None if it failed to resolve.
+        self.resolved_paths = {}
+        # Maps (object name, time, invert, flipx, flipy, flipz) to the
+        # object's world transform tuple
+        self.transforms = {}
+        # Maps (node class, path, ignore_defaults, path prefix and suffix)
+        # to the node's translated (directive_type, ParamSet)
+        self.node_translations = {}
+        # Maps node type names, with their category, to their NodeTypeInfo
+        self.node_types = {}
+        # Maps full instancer object names to their SohoGeometry and
+        # prefetched point attributes.
+        self.full_instancers = {}
+        # Maps (SOP path, attribute names, time) to the point attributes
+        # fetched by PBRTinstancing, empty if the SOP has no geometry.
+        self.point_attribs = {}
+        # Maps (shop, canonical override) to the name of its NamedMaterial
+        self.override_materials = {}
+        # Maps (medium, overrides) to the name and ParamSet of its NamedMedium
+        self.instance_mediums = {}
+        # Maps fast instancer object names to their _HybridInstances
+        self.hybrid_instancers = {}
+        # Maps (instance geo, shop, canonical override) to a prototype name
+        self.hybrid_prototypes = {}
+        # Maps fast instancer object names to their _FastInstances
+        self.fast_instancers = {}
+        # Maps instanced object paths to their world space bounding sphere
+        self.prototype_bounds = {}
+        # Maps instanced object paths to a list of it and its LOD variants
+        self.lod_variants = {}
+        # Maps fast instancer object paths used as instances to their
+        # flattened list of (prototype, hou.Matrix4)
+        self.flattened_instancers = {}
 
         self.rop = None
         self.hip = None
@@ -99,11 +320,48 @@ if gdp is not None:
         self.invalid_shading_nodes.clear()
         self.medium_nodes.clear()
         self.instanced_geo.clear()
+        self.packed_prototypes.clear()
+        self.object_depth = 0
+        self.autoinstance_prototypes.clear()
         self.interior = None
         self.exterior = None
+        self.stats.clear()
+        self.camera_view = None
+        self.resolved_paths.clear()
+        self.transforms.clear()
+        self.node_translations.clear()
+        self.node_types.clear()
+        self.full_instancers.clear()
+        self.point_attribs.clear()
+        self.override_materials.clear()
+        self.instance_mediums.clear()
+        self.hybrid_instancers.clear()
+        self.hybrid_prototypes.clear()
+        self.fast_instancers.clear()
+        self.prototype_bounds.clear()
+        self.lod_variants.clear()
+        self.flattened_instancers.clear()
         self.remove_tesselator()
         return
 
+    def resolve_path(self, base_node, path):
+        """Resolves a path relative to base_node, caching the result
+
+        Args:
+            base_node (hou.Node): Node to resolve relative paths from
+            path (str): Absolute or relative node path
+        Returns: The absolute path of the node or None if it doesn't exist
+        """
+        key = (base_node.path(), path)
+        if key in self.resolved_paths:
+            self.stats.add("Instance path cache hits")
+            return self.resolved_paths[key]
+        self.stats.add("Instance path cache misses")
+        node = base_node.node(path)
+        resolved = None if node is None else node.path()
+        self.resolved_paths[key] = resolved
+        return resolved
+
     def tesselate_geo(self, geo):
         if hou.applicationVersion() >= HVER_17_5:
             return self.tesselate_geo_with_verbs(geo)
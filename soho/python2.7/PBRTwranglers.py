@@ -10,9 +10,9 @@ import PBRTapi as api
 import PBRTgeo as Geo
 import PBRTinstancing as Instancing
 
-from PBRTstate import scene_state
+from PBRTstate import scene_state, CameraView
 from PBRTsoho import SohoPBRT
-from PBRTnodes import PBRTParam, ParamSet, BaseNode
+from PBRTnodes import PBRTParam, ParamSet, BaseNode, canonical_override
 
 __all__ = [
     "wrangle_film",
@@ -59,17 +59,33 @@ def get_wrangler(obj, now, style):  # pragma: no coverage
 
 
 def get_transform(obj, now, invert=False, flipx=False, flipy=False, flipz=False):
+    """Returns the world transform of a Soho Object as a tuple
+
+    Transforms are cached for the duration of a render, as an object is
+    evaluated for each shutter time and again when it is an instance's
+    prototype or a geo light's geometry.
+    """
+    key = (obj.getName(), now, invert, flipx, flipy, flipz)
+    if key in scene_state.transforms:
+        scene_state.stats.add("Transform cache hits")
+        return scene_state.transforms[key]
+    scene_state.stats.add("Transform cache misses")
+
     xform = []
     if not obj.evalFloat("space:world", now, xform):
-        return None
-    xform = hou.Matrix4(xform)
-    if invert:
-        xform = xform.inverted()
-    x = -1 if flipx else 1
-    y = -1 if flipy else 1
-    z = -1 if flipz else 1
-    xform = xform * hou.hmath.buildScale(x, y, z)
-    return list(xform.asTuple())
+        xform = None
+    elif invert or flipx or flipy or flipz:
+        xform = hou.Matrix4(xform)
+        if invert:
+            xform = xform.inverted()
+        x = -1 if flipx else 1
+        y = -1 if flipy else 1
+        z = -1 if flipz else 1
+        xform = (xform * hou.hmath.buildScale(x, y, z)).asTuple()
+    else:
+        xform = tuple(xform)
+    scene_state.transforms[key] = xform
+    return xform
 
 
 def xform_to_api_srt(xform, scale=True, rotate=True, trans=True):
@@ -143,30 +159,21 @@ def wrangle_node_parm(obj, parm_name, now):
 
 
 def process_full_pt_instance_medium(instance_info, medium_type):
-    gdp = instance_info.gdp
+    attribs = instance_info.attribs
 
     if medium_type not in ("interior", "exterior"):
         return None, None
 
-    medium_attrib_h = gdp.attribute("geo:point", "pbrt_" + medium_type)
-    if medium_attrib_h < 0:
+    medium_values = attribs.get("pbrt_" + medium_type)
+    if medium_values is None:
         return None, None
 
-    medium = gdp.value(medium_attrib_h, instance_info.number)[0]
+    medium = medium_values[instance_info.number][0]
 
     # an empty string is valid here as it means no medium
     if medium == "":
         return medium, ParamSet()
 
-    suffix = ":%s[%i]" % (instance_info.source, instance_info.number)
-    medium_node = BaseNode.from_node(medium)
-    medium_node.path_suffix = suffix
-
-    if not (medium_node and medium_node.directive_type == "pbrt_medium"):
-        return None, None
-
-    medium_paramset = ParamSet(medium_node.paramset)
-
     # TODO: Currently both this and the geometry overrides
     #       for mediums only support "rgb" and not spectrums.
     parms = {
@@ -177,21 +184,43 @@ def process_full_pt_instance_medium(instance_info, medium_type):
         "scale": "float",
     }
 
-    for parm, ptype in parms.iteritems():
-        attrib_name = "%s_%s" % (medium_type, parm)
-        attrib_h = gdp.attribute("geo:point", attrib_name)
-        if attrib_h < 0:
-            continue
-        # TODO: Checks?
-        # attrib_size = gdp.attribProperty(attrib_h, "geo:vectorsize")[0]
-        # attrib_storage = gdp.attribProperty(attrib_h, "geo:storage")[0]
-        val = gdp.value(attrib_h, instance_info.number)
-        medium_paramset.replace(PBRTParam(ptype, parm, val))
+    # TODO: Checks on the attribute's size and storage?
+    overrides = tuple(
+        (parm, attribs["%s_%s" % (medium_type, parm)][instance_info.number])
+        for parm in sorted(parms)
+        if "%s_%s" % (medium_type, parm) in attribs
+    )
+
+    # Points with the same medium and override values share a single
+    # NamedMedium instead of each point outputting its own.
+    key = (medium, overrides)
+    if key in scene_state.instance_mediums:
+        scene_state.stats.add("Point instance medium references")
+        return scene_state.instance_mediums[key]
+
+    suffix = ":%s[%i]" % (instance_info.source, instance_info.number)
+    medium_node = BaseNode.from_node(medium)
+    medium_node.path_suffix = suffix
+
+    if not (medium_node and medium_node.directive_type == "pbrt_medium"):
+        return None, None
+
+    medium_paramset = ParamSet(medium_node.paramset)
+    for parm, val in overrides:
+        medium_paramset.replace(PBRTParam(parms[parm], parm, val))
 
     # We might be outputing a named medium even if its not going to be needed
     # as in the case of instancing volume prims
     api.MakeNamedMedium(medium_node.full_name, "homogeneous", medium_paramset)
 
+    scene_state.instance_mediums[key] = (medium_node.full_name, medium_paramset)
+    scene_state.stats.add("Point instance mediums")
+    scene_state.stats.add("Point instance medium references")
+    scene_state.stats.add_ratio(
+        "Point instance medium reuse",
+        "Point instance mediums",
+        "Point instance medium references",
+    )
     return medium_node.full_name, medium_paramset
 
 
@@ -205,21 +234,26 @@ def process_full_pt_instance_material(instance_info):
     #   5. nothing
     #   The choice between 3 and 4 is handled automatically by soho
 
-    gdp = instance_info.gdp
-
-    override_attrib_h = gdp.attribute("geo:point", "material_override")
-    shop_attrib_h = gdp.attribute("geo:point", "shop_materialpath")
+    attribs = instance_info.attribs
 
-    if shop_attrib_h < 0:
+    if "shop_materialpath" not in attribs:
         return False
 
-    shop = gdp.value(shop_attrib_h, instance_info.number)[0]
+    shop = attribs["shop_materialpath"][instance_info.number][0]
 
     override_str = ""
-    if override_attrib_h >= 0:
-        override_str = gdp.value(override_attrib_h, instance_info.number)[0]
+    if "material_override" in attribs:
+        override_str = attribs["material_override"][instance_info.number][0]
 
     # We can just reference a NamedMaterial since there are no overrides
+    # or the override was already output by output_full_pt_instance_materials
+    if override_str:
+        key = (shop, canonical_override(override_str))
+        if key in scene_state.override_materials:
+            api.NamedMaterial(scene_state.override_materials[key])
+            scene_state.stats.add("Point override material references")
+            return True
+
     if not override_str:
         if shop in scene_state.shading_nodes:
             api.NamedMaterial(shop)
@@ -241,6 +275,54 @@ def process_full_pt_instance_material(instance_info):
     return True
 
 
+def output_override_material(shop, override_str):
+    """Outputs a NamedMaterial of the shop with the override applied
+
+    Each unique shop and override is only output once, the NamedMaterial's
+    name is recorded in the scene_state's override_materials.
+
+    Returns: The name of the NamedMaterial or None if it could not be output
+    """
+    key = (shop, canonical_override(override_str))
+    if key in scene_state.override_materials:
+        return scene_state.override_materials[key]
+    suffix = ":override%i" % len(scene_state.override_materials)
+    wrangle_shading_network(shop, name_suffix=suffix, overrides=override_str)
+    if shop + suffix not in scene_state.shading_nodes:
+        return None
+    scene_state.override_materials[key] = shop + suffix
+    scene_state.stats.add("Point override materials")
+    scene_state.stats.add_ratio(
+        "Point override material reuse",
+        "Point override materials",
+        "Point override material references",
+    )
+    return shop + suffix
+
+
+def output_full_pt_instance_materials(instance_info):
+    """Outputs the NamedMaterials used by a full instance's point
+
+    Many points of a full instancer will share the same material_override.
+    Rather than expanding a network per point, each unique combination is
+    output once, at the world level, and the instances reference it by name.
+    """
+    attribs = instance_info.attribs
+    if "shop_materialpath" not in attribs:
+        return
+
+    shop = attribs["shop_materialpath"][instance_info.number][0]
+    if not shop:
+        return
+    wrangle_shading_network(shop)
+    if "material_override" not in attribs:
+        return
+    override_str = attribs["material_override"][instance_info.number][0]
+    if override_str:
+        output_override_material(shop, override_str)
+    return
+
+
 def wrangle_shading_network(
     node_path,
     name_prefix="",
@@ -265,11 +347,9 @@ def wrangle_shading_network(
         saved_nodes = scene_state.shading_nodes
 
     # NOTE: We prefix and suffix names here so that there are not collisions when
-    #       using full point instancing. There is some possible redundancy as the same
-    #       network maybe recreated multiple times under different names if the
-    #       overrides are the same. A possible optimization for export and PBRT is to
-    #       do a prepass and build the networks before and keep a map to the pre-built
-    #       networks. For now we'll brute force it.
+    #       using full point instancing. Point overrides are output once per unique
+    #       override by output_full_pt_instance_materials, so networks are only
+    #       recreated per point if that prepass was skipped.
     presufed_node_path = name_prefix + node_path + name_suffix
     if presufed_node_path in saved_nodes:
         return
@@ -569,6 +649,9 @@ def wrangle_camera(obj, wrangler, now):
 
     node = wrangle_node_parm(obj, "camera_node", now)
     if node is not None:
+        # The view of a camera node isn't known, so any screen space
+        # measurements are disabled.
+        scene_state.camera_view = None
         output_cam_xform(obj, node.directive_type, now)
         return node.type_and_paramset
 
@@ -622,11 +705,13 @@ def wrangle_camera(obj, wrangler, now):
             (window[3] - 0.5) * 2.0 / aspectfix,
         ]
         paramset.add(PBRTParam("float", "screenwindow", screen))
+        view_scale = focal / aperture
 
     elif projection == "ortho":
         projection_name = "orthographic"
 
         width = parms["orthowidth"].Value[0]
+        view_scale = 1.0 / width
         screen = [
             (window[0] - 0.5) * width,
             (window[1] - 0.5) * width,
@@ -637,9 +722,19 @@ def wrangle_camera(obj, wrangler, now):
 
     elif projection == "sphere":
         projection_name = "environment"
+        view_scale = 1.0
     else:
         soho.error("Camera projection setting of %s not supported by PBRT" % projection)
 
+    scene_state.camera_view = CameraView(
+        hou.Matrix4(get_transform(obj, now)),
+        projection_name,
+        parms["res"].Value,
+        window,
+        view_scale,
+        aspectfix,
+    )
+
     output_cam_xform(obj, projection_name, now)
 
     return (projection_name, paramset)
@@ -846,7 +941,9 @@ def wrangle_light(light, wrangler, now):
     return
 
 
-def wrangle_obj(obj, wrangler, now, ignore_xform=False, concat_xform=False):
+def wrangle_obj(
+    obj, wrangler, now, ignore_xform=False, concat_xform=False, ignore_shop=False
+):
 
     ptinstance = []
     has_ptinstance = obj.evalInt("ptinstance", now, ptinstance)
@@ -857,15 +954,16 @@ def wrangle_obj(obj, wrangler, now, ignore_xform=False, concat_xform=False):
     if has_ptinstance and ptinstance[0] == 2:
         # This is "fast instancing", "full instancing" results in Soho outputing
         # actual objects which independently need to be wrangled.
-        Instancing.wrangle_fast_instances(obj, now)
+        Instancing.wrangle_fast_instances(obj, now, wrangle_motionblur(obj, now))
         return
 
-    wrangle_geo(obj, wrangler, now)
+    wrangle_geo(obj, wrangler, now, ignore_shop=ignore_shop)
     return
 
 
-def wrangle_geo(obj, wrangler, now):
-    parm_selection = {
+def geo_parm_selection():
+    """Returns the SohoParms of an object's properties used by wrangle_geo"""
+    return {
         "object:soppath": SohoPBRT("object:soppath", "string", [""], skipdefault=False),
         "ptinstance": SohoPBRT("ptinstance", "integer", [0], skipdefault=False),
         # NOTE: In order for shop_materialpath to evaluate correctly when using
@@ -880,7 +978,30 @@ def wrangle_geo(obj, wrangler, now):
         "pbrt_subdlevels": SohoPBRT(
             "pbrt_subdlevels", "integer", [3], False, key="levels"
         ),
+        "pbrt_subdauto": SohoPBRT("pbrt_subdauto", "bool", [False], True),
+        "pbrt_subdedgelength": SohoPBRT(
+            "pbrt_subdedgelength", "float", [4], False, key="subdedgelength"
+        ),
+        "pbrt_predicesubd": SohoPBRT("pbrt_predicesubd", "bool", [False], True),
+        "pbrt_subdcachedir": SohoPBRT(
+            "pbrt_subdcachedir", "string", [""], True, key="cachedir"
+        ),
         "pbrt_computeN": SohoPBRT("pbrt_computeN", "bool", [True], False),
+        "pbrt_packedcachedir": SohoPBRT(
+            "pbrt_packedcachedir", "string", [""], True, key="packedcachedir"
+        ),
+        "pbrt_lod": SohoPBRT("pbrt_lod", "bool", [False], True),
+        "pbrt_lodedgelength": SohoPBRT(
+            "pbrt_lodedgelength", "float", [8], False, key="lodedgelength"
+        ),
+        "pbrt_lodmargin": SohoPBRT(
+            "pbrt_lodmargin", "float", [0], False, key="lodmargin"
+        ),
+        "pbrt_weld": SohoPBRT("pbrt_weld", "bool", [False], True),
+        "pbrt_weldtolerance": SohoPBRT(
+            "pbrt_weldtolerance", "float", [0], False, key="weldtolerance"
+        ),
+        "pbrt_spatialorder": SohoPBRT("pbrt_spatialorder", "bool", [False], True),
         "pbrt_reverseorientation": SohoPBRT(
             "pbrt_reverseorientation", "bool", [False], True
         ),
@@ -911,7 +1032,13 @@ def wrangle_geo(obj, wrangler, now):
         ),
         # TODO, Tesselation options?
     }
-    properties = obj.evaluate(parm_selection, now)
+
+
+def wrangle_geo(obj, wrangler, now, ignore_shop=False):
+    properties = obj.evaluate(geo_parm_selection(), now)
+    # Used for screen space measurements of the geometry
+    xform = get_transform(obj, now)
+    properties[".xform"] = None if xform is None else hou.Matrix4(xform)
 
     if "shop_materialpath" not in properties:
         shop = ""
@@ -952,7 +1079,9 @@ def wrangle_geo(obj, wrangler, now):
                 properties[".interior_overrides"] = interior_paramset
 
     # If we found a point shop, don't output the default one here.
-    if shop in scene_state.shading_nodes and not pt_shop_found:
+    # The same applies if the caller has already bound a material, such as
+    # within a hybrid instance's prototype.
+    if shop in scene_state.shading_nodes and not (pt_shop_found or ignore_shop):
         api.NamedMaterial(shop)
 
     # We only output a MediumInterface if one or both of the parms exist
@@ -1,6 +1,10 @@
 import os
+import sys
+import math
+import array
 import shutil
 import filecmp
+import tempfile
 import unittest
 
 import hou
@@ -114,6 +118,30 @@ def build_archive(diskfile=None):
     return rop
 
 
+class FakeSohoObject(object):
+    """Stands in for a soho.SohoObject, which only exists during a render
+
+    Args:
+        name (str): Object name
+        xforms (dict): Maps times to the world transform at that time
+    """
+
+    def __init__(self, name, xforms):
+        self.name = name
+        self.xforms = xforms
+        self.evaluations = 0
+
+    def getName(self):
+        return self.name
+
+    def evalFloat(self, parm, now, value):
+        self.evaluations += 1
+        if parm != "space:world" or now not in self.xforms:
+            return False
+        value.extend(self.xforms[now])
+        return True
+
+
 class TestParamBase(unittest.TestCase):
 
     # In order to import the Soho related PBRT modules we need to
@@ -133,9 +161,10 @@ class TestParamBase(unittest.TestCase):
 
     def setUp(self):
         self.rop.render()
-        from PBRTnodes import PBRTParam
+        from PBRTnodes import PBRTParam, ParamSet
 
         self.PBRTParam = PBRTParam
+        self.ParamSet = ParamSet
 
     def test_invalid_type(self):
         with self.assertRaises(TypeError):
@@ -182,6 +211,455 @@ class TestParamBase(unittest.TestCase):
         param = self.PBRTParam("spectrum", "my_name", gen)
         self.assertEqual(str(param), "spectrum my_name [ ... ]")
 
+    def test_spectrum_string_value(self):
+        param = self.PBRTParam("spectrum", "my_name", "[400, 1, 500, 1]")
+        listed = self.PBRTParam("spectrum", "my_name", [400, 1, 500, 1])
+        self.assertEqual(param.value, [400, 1, 500, 1])
+        # Parsed values are kept, so reading the value again is unchanged
+        self.assertEqual(param.value, [400, 1, 500, 1])
+        self.assertEqual(str(param), "spectrum my_name [ 400 1 500 ... ]")
+        self.assertEqual(param.as_str(), listed.as_str())
+
+    def test_spectrum_string_file(self):
+        filename = "spds/metals/Au.eta.spd"
+        param = self.PBRTParam("spectrum", "my_name", filename)
+        listed = self.PBRTParam("spectrum", "my_name", [filename])
+        self.assertEqual(param.value, [filename])
+        self.assertEqual(str(param), "spectrum my_name [ %s ]" % filename)
+        self.assertEqual(param.as_str(), listed.as_str())
+
+    def test_spectrum_string_equal_hash(self):
+        param = self.PBRTParam("spectrum", "my_name", "[400, 1, 500, 1]")
+        rgb = self.PBRTParam("rgb", "my_name", [1, 2, 3])
+        self.assertEqual(param, rgb)
+        self.assertEqual(hash(param), hash(rgb))
+        self.assertEqual(hash(param), hash(("spectrum", "my_name")))
+        self.assertNotEqual(param, self.PBRTParam("spectrum", "other", [0]))
+
+    def test_paramset_contains(self):
+        paramset = self.ParamSet([self.PBRTParam("float", "my_name", 1)])
+        self.assertIn(self.PBRTParam("float", "my_name", 2), paramset)
+        self.assertNotIn(self.PBRTParam("integer", "my_name", 1), paramset)
+        self.assertNotIn("my_name", paramset)
+        self.assertNotIn(None, paramset)
+
+    def test_paramset_add_does_not_replace(self):
+        paramset = self.ParamSet([self.PBRTParam("float", "my_name", 1)])
+        paramset.add(self.PBRTParam("float", "my_name", 2))
+        self.assertEqual(len(paramset), 1)
+        self.assertEqual(paramset.find_param("float", "my_name").value, [1])
+        paramset.replace(self.PBRTParam("float", "my_name", 2))
+        self.assertEqual(len(paramset), 1)
+        self.assertEqual(paramset.find_param("float", "my_name").value, [2])
+
+    def test_paramset_sorted(self):
+        paramset = self.ParamSet()
+        paramset.add(self.PBRTParam("string", "b", "x"))
+        paramset.add(self.PBRTParam("float", "c", 1))
+        paramset.add(self.PBRTParam("float", "a", 1))
+        self.assertEqual(
+            [(x.type, x.name) for x in paramset],
+            [("float", "a"), ("float", "c"), ("string", "b")],
+        )
+
+    def test_paramset_copy_on_write(self):
+        original = self.ParamSet([self.PBRTParam("float", "a", 1)])
+        copy = self.ParamSet(original)
+        self.assertIs(copy._data, original._data)
+        copy.replace(self.PBRTParam("float", "a", 2))
+        copy.add(self.PBRTParam("float", "b", 1))
+        self.assertIsNot(copy._data, original._data)
+        self.assertEqual(len(original), 1)
+        self.assertEqual(original.find_param("float", "a").value, [1])
+        self.assertEqual(copy.find_param("float", "a").value, [2])
+
+    def test_paramset_copy_of_copy(self):
+        original = self.ParamSet([self.PBRTParam("float", "a", 1)])
+        copy1 = self.ParamSet(original)
+        copy2 = self.ParamSet(copy1)
+        original.discard(self.PBRTParam("float", "a", 1))
+        self.assertEqual(len(original), 0)
+        self.assertEqual(len(copy1), 1)
+        self.assertEqual(len(copy2), 1)
+        copy1.update([self.PBRTParam("float", "b", 1)])
+        self.assertEqual(len(copy1), 2)
+        self.assertEqual(len(copy2), 1)
+
+    def test_node_translation_copy(self):
+        from PBRTnodes import MaterialNode
+
+        matte = hou.node("/mat").createNode("pbrt_material_matte")
+        try:
+            matte.parm("sigma").set(5)
+            paramset = MaterialNode(matte.path()).paramset
+            sigma = paramset.find_param("float", "sigma")
+            self.assertEqual(sigma.value, [5])
+            # Apply an override and add a parm to the returned ParamSet
+            paramset.update(
+                MaterialNode(matte.path()).override_paramset('{"sigma": 10}')
+            )
+            paramset.add(self.PBRTParam("float", "extra", 1))
+            self.assertEqual(paramset.find_param("float", "sigma").value, [10])
+            # The next translation of the node comes from the cache, unchanged
+            node = MaterialNode(matte.path())
+            for paramset in (node.paramset, node.type_and_paramset[1]):
+                self.assertEqual(paramset.find_param("float", "sigma").value, [5])
+                self.assertIsNone(paramset.find_param("float", "extra"))
+        finally:
+            matte.destroy()
+
+    def test_spare_parm_per_node(self):
+        from PBRTnodes import MaterialNode, node_type_info
+        from PBRTstate import scene_state
+
+        spare = hou.node("/mat").createNode("pbrt_material_matte")
+        plain = hou.node("/mat").createNode("pbrt_material_matte")
+        try:
+            plain_params = [str(param) for param in MaterialNode(plain.path()).paramset]
+            ptg = spare.parmTemplateGroup()
+            ptg.append(hou.FloatParmTemplate("extra", "Extra", 1, default_value=(1,)))
+            spare.setParmTemplateGroup(ptg)
+            spare.parm("extra").set(2)
+            spare_paramset = MaterialNode(spare.path()).paramset
+            self.assertEqual(spare_paramset.find_param("float", "extra").value, [2])
+            # The other node of the same type is unaffected
+            self.assertEqual(
+                [str(param) for param in MaterialNode(plain.path()).paramset],
+                plain_params,
+            )
+            # And so are nodes translated for the first time
+            scene_state.node_translations.clear()
+            self.assertEqual(
+                [str(param) for param in MaterialNode(plain.path()).paramset],
+                plain_params,
+            )
+            self.assertNotIn("extra", node_type_info(plain.type()).parms)
+        finally:
+            spare.destroy()
+            plain.destroy()
+
+
+class TestGeoHelpers(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.cam = build_cam()
+        cls.rop = build_rop()
+        cls.rop.parm("filename").set("/dev/null")
+
+    @classmethod
+    def tearDownClass(cls):
+        hou.hipFile.clear(suppress_save_prompt=True)
+
+    def setUp(self):
+        self.rop.render()
+        import PBRTgeo
+
+        self.Geo = PBRTgeo
+
+    def test_weld_exact(self):
+        P = array.array("f", [0, 0, 0, 1, 0, 0, 0, 1, 0, 1, 0, 0, 0, 1, 0, 1, 1, 0])
+        indices, attribs = self.Geo.weld_vertices([0, 1, 2, 3, 5, 4], [P])
+        self.assertEqual(list(indices), [0, 1, 2, 1, 3, 2])
+        self.assertEqual(len(attribs[0]), 12)
+
+    def test_weld_split_attribs(self):
+        P = array.array("f", [0, 0, 0, 0, 0, 0])
+        uv = array.array("f", [0, 0, 0, 1, 0, 0])
+        indices, attribs = self.Geo.weld_vertices([0, 1], [P, uv])
+        self.assertEqual(list(indices), [0, 1])
+
+    def test_weld_tolerance(self):
+        P = array.array("f", [0, 0, 0, 0.0001, 0, 0, 1, 0, 0])
+        indices, attribs = self.Geo.weld_vertices([0, 1, 2], [P], 0.001)
+        self.assertEqual(list(indices), [0, 0, 1])
+        self.assertEqual(len(attribs[0]), 6)
+
+    def test_spatial_reorder(self):
+        # Two triangles far apart with a third between them
+        P = array.array(
+            "f",
+            [10, 0, 0, 11, 0, 0, 10, 1, 0]
+            + [0, 0, 0, 1, 0, 0, 0, 1, 0]
+            + [5, 0, 0, 6, 0, 0, 5, 1, 0],
+        )
+        faces = array.array("i", [0, 1, 2])
+        indices, attribs, prim_attribs = self.Geo.spatial_reorder(
+            [0, 1, 2, 3, 4, 5, 6, 7, 8], [P], [faces]
+        )
+        self.assertEqual(list(indices), [0, 1, 2, 3, 4, 5, 6, 7, 8])
+        self.assertEqual(list(prim_attribs[0]), [1, 2, 0])
+        self.assertEqual(list(attribs[0][:3]), [0, 0, 0])
+        self.assertEqual(list(attribs[0][-3:]), [10, 1, 0])
+
+    def test_camera_view(self):
+        from PBRTstate import CameraView
+
+        # A scale of 1 covers a width of 10 units at a depth of 10
+        view = CameraView(hou.Matrix4(1), "perspective", [100, 100], [0, 1, 0, 1])
+        bbox = hou.BoundingBox(-0.5, -0.5, -0.5, 0.5, 0.5, 0.5)
+        ahead = hou.hmath.buildTranslate(0, 0, -10)
+        behind = hou.hmath.buildTranslate(0, 0, 10)
+        self.assertTrue(view.in_frustum(bbox, ahead))
+        self.assertFalse(view.in_frustum(bbox, behind))
+        self.assertTrue(view.in_frustum(bbox, behind, margin=10))
+        self.assertAlmostEqual(view.distance(bbox, behind), 9.5)
+        self.assertAlmostEqual(
+            view.projected_size(bbox, ahead), 100 * math.sqrt(3) / 9.5, places=4
+        )
+
+    def test_cull_instances(self):
+        import PBRTinstancing
+        from PBRTstate import CameraView
+
+        view = CameraView(hou.Matrix4(1), "perspective", [100, 100], [0, 1, 0, 1])
+        ahead = hou.Vector3(0, 0, -10)
+        aside = hou.Vector3(20, 0, -10)
+        behind = hou.Vector3(0, 0, 10)
+        far = hou.Vector3(0, 0, -1000)
+        self.assertFalse(PBRTinstancing._culled(view, ahead, 0.5))
+        self.assertTrue(PBRTinstancing._culled(view, aside, 0.5))
+        self.assertTrue(PBRTinstancing._culled(view, behind, 0.5))
+        self.assertFalse(PBRTinstancing._culled(view, aside, 0.5, margin=20))
+        self.assertFalse(PBRTinstancing._culled(view, far, 0.5))
+        # A diameter of 1 at a depth of 9.5 is about 10.5 pixels
+        self.assertFalse(PBRTinstancing._culled(view, ahead, 0.5, min_pixels=10))
+        self.assertTrue(PBRTinstancing._culled(view, ahead, 0.5, min_pixels=11))
+        self.assertTrue(PBRTinstancing._culled(view, far, 0.5, min_pixels=1))
+
+    def test_lod_level(self):
+        import PBRTinstancing
+
+        lod_level = PBRTinstancing._lod_level
+        self.assertEqual(lod_level(512, 256), 0)
+        self.assertEqual(lod_level(256, 256), 0)
+        self.assertEqual(lod_level(255.9, 256), 1)
+        self.assertEqual(lod_level(128, 256), 1)
+        self.assertEqual(lod_level(127.9, 256), 2)
+        self.assertEqual(lod_level(64, 256), 2)
+        self.assertEqual(lod_level(63.9, 256), 3)
+        self.assertEqual(lod_level(1, 256), 8)
+        self.assertEqual(lod_level(0.9, 256), 9)
+        self.assertEqual(lod_level(0, 256), sys.maxint)
+
+    def test_lod_reduction(self):
+        # 10 edges across is a budget of 200 triangles, rounded up to 256
+        self.assertEqual(self.Geo.lod_reduction(80, 8, 1024), (256, 25.0))
+        self.assertEqual(self.Geo.lod_reduction(81, 8, 1024), (256, 25.0))
+        self.assertEqual(self.Geo.lod_reduction(120, 8, 1024), (512, 50.0))
+        # Already within the budget
+        self.assertIsNone(self.Geo.lod_reduction(80, 8, 256))
+        self.assertIsNone(self.Geo.lod_reduction(80, 8, 100))
+        # Tiny meshes are not reduced past the minimum budget
+        self.assertEqual(self.Geo.lod_reduction(0, 8, 400), (64, 16.0))
+        self.assertEqual(self.Geo.lod_reduction(10, 8, 400), (64, 16.0))
+        self.assertIsNone(self.Geo.lod_reduction(0, 8, 64))
+
+    def test_lod_decimate_outside_view(self):
+        from PBRTstate import CameraView
+
+        sphere_verb = hou.sopNodeTypeCategory().nodeVerb("sphere")
+        sphere_verb.setParms({"type": 1, "freq": 20})
+        gdp = hou.Geometry()
+        sphere_verb.execute(gdp, [])
+        gdp = self.Geo.scene_state.tesselate_geo(gdp)
+        num_tris = gdp.intrinsicValue("primitivecount")
+        view = self.Geo.scene_state.camera_view
+        self.Geo.scene_state.camera_view = CameraView(
+            hou.Matrix4(1), "perspective", [100, 100], [0, 1, 0, 1]
+        )
+        try:
+            # Far in front of the camera the sphere is decimated
+            far = hou.hmath.buildTranslate(0, 0, -1000)
+            lod_gdp = self.Geo.lod_decimate(gdp, far, 8)
+            self.assertLess(lod_gdp.intrinsicValue("primitivecount"), num_tris)
+            # Behind or beside the camera it has no size on screen
+            behind = hou.hmath.buildTranslate(0, 0, 1000)
+            self.assertIs(self.Geo.lod_decimate(gdp, behind, 8), gdp)
+            beside = hou.hmath.buildTranslate(1000, 0, -10)
+            self.assertIs(self.Geo.lod_decimate(gdp, beside, 8), gdp)
+            # Unless the margin brings it into view
+            lod_gdp = self.Geo.lod_decimate(gdp, beside, 8, margin=1000)
+            self.assertLess(lod_gdp.intrinsicValue("primitivecount"), num_tris)
+        finally:
+            self.Geo.scene_state.camera_view = view
+
+    def test_adaptive_subd_level(self):
+        from PBRTstate import CameraView
+
+        box_verb = hou.sopNodeTypeCategory().nodeVerb("box")
+        gdp = hou.Geometry()
+        box_verb.execute(gdp, [])
+        gdp = self.Geo.scene_state.tesselate_geo(gdp)
+        # Each triangle has two sides and a diagonal
+        self.assertAlmostEqual(
+            self.Geo.average_edge_length(gdp), (2 + math.sqrt(2)) / 3, places=5
+        )
+        view = self.Geo.scene_state.camera_view
+        self.Geo.scene_state.camera_view = CameraView(
+            hou.Matrix4(1), "perspective", [100, 100], [0, 1, 0, 1]
+        )
+        near = hou.hmath.buildTranslate(0, 0, -1.5)
+        far = hou.hmath.buildTranslate(0, 0, -10.5)
+        try:
+            # Edges project to about 114 pixels when near and 11 when far
+            self.assertEqual(self.Geo.adaptive_subd_level(gdp, far, 8, 10), 1)
+            self.assertEqual(self.Geo.adaptive_subd_level(gdp, near, 8, 10), 4)
+            # A finer target edge length needs more levels
+            self.assertEqual(self.Geo.adaptive_subd_level(gdp, far, 1, 10), 4)
+            # Clamped to the maximum level
+            self.assertEqual(self.Geo.adaptive_subd_level(gdp, near, 8, 2), 2)
+            # Already finer than the target
+            self.assertEqual(self.Geo.adaptive_subd_level(gdp, far, 16, 10), 0)
+        finally:
+            self.Geo.scene_state.camera_view = view
+
+    def test_predice_loopsubdiv(self):
+        box_verb = hou.sopNodeTypeCategory().nodeVerb("box")
+        gdp = hou.Geometry()
+        box_verb.execute(gdp, [])
+        gdp = self.Geo.scene_state.tesselate_geo(gdp)
+        diced_gdp = self.Geo.predice_loopsubdiv(gdp, 1)
+        # Loop splits each of the 12 triangles into 4 and adds a point on
+        # each of the 18 edges, Catmull-Clark would output quads instead.
+        self.assertEqual(diced_gdp.intrinsicValue("primitivecount"), 48)
+        self.assertEqual(diced_gdp.intrinsicValue("pointcount"), 26)
+        self.assertEqual(diced_gdp.intrinsicValue("vertexcount"), 48 * 3)
+
+    def test_transform_cache(self):
+        from PBRTwranglers import get_transform
+
+        shutter_close = 0.5 / 24
+        obj = FakeSohoObject(
+            "/obj/geo1",
+            {
+                0: hou.hmath.identityTransform().asTuple(),
+                shutter_close: hou.hmath.buildTranslate(1, 0, 0).asTuple(),
+            },
+        )
+        xform = get_transform(obj, 0)
+        self.assertIs(get_transform(obj, 0), xform)
+        self.assertEqual(obj.evaluations, 1)
+        # Each motion blur time sample is cached separately
+        xform_close = get_transform(obj, shutter_close)
+        self.assertEqual(obj.evaluations, 2)
+        self.assertNotEqual(xform_close, xform)
+        self.assertIs(get_transform(obj, shutter_close), xform_close)
+        self.assertIs(get_transform(obj, 0), xform)
+        # As are inverted transforms
+        inverted = get_transform(obj, shutter_close, invert=True)
+        self.assertEqual(inverted[12], -1)
+        self.assertEqual(obj.evaluations, 3)
+        # Missing transforms are cached too
+        self.assertIsNone(get_transform(obj, 1))
+        self.assertIsNone(get_transform(obj, 1))
+        self.assertEqual(obj.evaluations, 4)
+        self.Geo.scene_state.reset()
+        self.assertEqual(get_transform(obj, 0), xform)
+        self.assertEqual(obj.evaluations, 5)
+
+    def test_resolve_path_cache(self):
+        scene_state = self.Geo.scene_state
+        geo = hou.node("/obj").createNode("geo")
+        try:
+            sphere = geo.createNode("sphere")
+            self.assertEqual(scene_state.resolve_path(geo, "sphere1"), sphere.path())
+            self.assertEqual(scene_state.resolve_path(geo, "missing"), None)
+            # Both lookups are served from the cache, even after the nodes
+            # change, until the state is reset at the end of a render.
+            sphere.setName("renamed")
+            geo.createNode("null", "missing")
+            self.assertEqual(scene_state.resolve_path(geo, "sphere1"), sphere.path())
+            self.assertIsNone(scene_state.resolve_path(geo, "missing"))
+            self.assertEqual(len(scene_state.resolved_paths), 2)
+            scene_state.reset()
+            self.assertEqual(len(scene_state.resolved_paths), 0)
+            self.assertIsNone(scene_state.resolve_path(geo, "sphere1"))
+            self.assertEqual(
+                scene_state.resolve_path(geo, "missing"), geo.path() + "/missing"
+            )
+        finally:
+            geo.destroy()
+
+    def test_fetch_point_attribs_cache(self):
+        import PBRTinstancing
+
+        scene_state = self.Geo.scene_state
+        geo = hou.node("/obj").createNode("geo")
+        try:
+            add_sop = geo.createNode("add")
+            add_sop.parm("usept0").set(True)
+            attrib_sop = geo.createNode("attribcreate")
+            attrib_sop.setFirstInput(add_sop)
+            attrib_sop.parm("name1").set("pscale")
+            attrib_sop.parm("value1v1").set(2)
+            names = ("pscale", "missing")
+            attribs = PBRTinstancing._fetch_point_attribs(attrib_sop.path(), names, 0)
+            self.assertEqual(attribs, {"pscale": [(2.0,)]})
+            # Served from the cache until the state is reset
+            attrib_sop.parm("value1v1").set(3)
+            self.assertIs(
+                PBRTinstancing._fetch_point_attribs(attrib_sop.path(), names, 0),
+                attribs,
+            )
+            # Including SOPs which don't exist
+            missing = geo.path() + "/missing"
+            self.assertEqual(PBRTinstancing._fetch_point_attribs(missing, names, 0), {})
+            self.assertIn((missing, names, 0), scene_state.point_attribs)
+            scene_state.reset()
+            self.assertEqual(len(scene_state.point_attribs), 0)
+            self.assertEqual(
+                PBRTinstancing._fetch_point_attribs(attrib_sop.path(), names, 0),
+                {"pscale": [(3.0,)]},
+            )
+        finally:
+            geo.destroy()
+
+    def test_write_ply(self):
+        import PBRTcache
+
+        P = array.array("f", [0, 0, 0, 1, 0, 0, 0, 1, 0])
+        N = array.array("f", [0, 0, 1] * 3)
+        indices = array.array("i", [0, 1, 2])
+        tmpdir = tempfile.mkdtemp()
+        try:
+            filename = PBRTcache.cache_filename(tmpdir, "test")
+            PBRTcache.write_ply(filename, P, indices, N=N)
+            with open(filename, "rb") as ply_file:
+                data = ply_file.read()
+            # The temporary file is renamed into place
+            self.assertEqual(os.listdir(tmpdir), ["test.ply"])
+            # With the permissions of a file created by open() rather than
+            # mkstemp's owner only ones
+            umask = os.umask(0)
+            os.umask(umask)
+            mode = os.stat(filename).st_mode & 0o777
+            self.assertEqual(mode, 0o666 & ~umask)
+        finally:
+            shutil.rmtree(tmpdir)
+        header, body = data.split("end_header\n")
+        self.assertIn("element vertex 3", header)
+        self.assertIn("property float nx", header)
+        self.assertIn("element face 1", header)
+        # 3 points of P and N, and 1 face of uchar + 3 ints
+        self.assertEqual(len(body), 3 * 6 * 4 + 13)
+
+    def test_file_key(self):
+        import PBRTcache
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmpdir, "test.obj")
+            with open(filename, "w") as obj_file:
+                obj_file.write("v 0 0 0\n")
+            key = PBRTcache.file_key(filename)
+            self.assertEqual(key, PBRTcache.file_key(filename))
+            self.assertNotEqual(key, PBRTcache.file_key(filename, False))
+            with open(filename, "a") as obj_file:
+                obj_file.write("v 1 0 0\n")
+            self.assertNotEqual(key, PBRTcache.file_key(filename))
+        finally:
+            shutil.rmtree(tmpdir)
+
 
 class TestBase(unittest.TestCase):
     @classmethod
@@ -481,6 +959,79 @@ class TestInstance(TestGeo):
         self.instance.parm("ptinstance").set("on")
         self.compare_scene()
 
+    def test_full_pt_instance_overrides(self):
+        matte = hou.node("/mat").createNode(
+            "pbrt_material_matte", run_init_scripts=False
+        )
+        add_sop = self.instance.createNode("add")
+        add_sop.parm("points").set(3)
+        add_sop.parm("usept0").set(True)
+        add_sop.parm("usept1").set(True)
+        add_sop.parm("usept2").set(True)
+        add_sop.parmTuple("pt1").set([2, 0, 0])
+        add_sop.parmTuple("pt2").set([4, 0, 0])
+        shop_sop = self.instance.createNode("attribcreate")
+        shop_sop.setFirstInput(add_sop)
+        shop_sop.parm("name1").set("shop_materialpath")
+        shop_sop.parm("type1").set("index")
+        shop_sop.parm("string1").set(matte.path())
+        # Points 0 and 1 have the same override written in a different order
+        # so share a NamedMaterial, point 2 has its own.
+        overrides = (
+            '{"sigma": 10, "Kdr": 0.1, "Kdg": 0.2, "Kdb": 0.3}',
+            '{"Kdb": 0.3, "Kdg": 0.2, "Kdr": 0.1, "sigma": 10}',
+            '{"sigma": 20}',
+        )
+        prev_sop = shop_sop
+        for pt, override in enumerate(overrides):
+            override_sop = self.instance.createNode("attribcreate")
+            override_sop.setFirstInput(prev_sop)
+            override_sop.parm("group").set(str(pt))
+            override_sop.parm("name1").set("material_override")
+            override_sop.parm("type1").set("index")
+            override_sop.parm("string1").set(override)
+            prev_sop = override_sop
+        prev_sop.setRenderFlag(True)
+        self.instance.parm("instancepath").set(self.geo1.path())
+        self.instance.parm("ptinstance").set("on")
+        self.compare_scene()
+        with open(self.testfile) as scene:
+            override_materials = [
+                line
+                for line in scene
+                if line.lstrip().startswith("MakeNamedMaterial") and ":override" in line
+            ]
+        self.assertEqual(len(override_materials), 2)
+
+    def test_full_pt_instance_mediums(self):
+        medium = hou.node("/mat").createNode("pbrt_medium")
+        add_sop = self.instance.createNode("add")
+        add_sop.parm("points").set(3)
+        add_sop.parm("usept0").set(True)
+        add_sop.parm("usept1").set(True)
+        add_sop.parm("usept2").set(True)
+        add_sop.parmTuple("pt1").set([2, 0, 0])
+        add_sop.parmTuple("pt2").set([4, 0, 0])
+        interior_sop = self.instance.createNode("attribcreate")
+        interior_sop.setFirstInput(add_sop)
+        interior_sop.parm("name1").set("pbrt_interior")
+        interior_sop.parm("type1").set("index")
+        interior_sop.parm("string1").set(medium.path())
+        # Points 0 and 1 share a NamedMedium, point 2's differs by its g
+        g_sop = self.instance.createNode("attribcreate")
+        g_sop.setFirstInput(interior_sop)
+        g_sop.parm("name1").set("interior_g")
+        g_sop.parm("value1v1").set(0.5)
+        g2_sop = self.instance.createNode("attribcreate")
+        g2_sop.setFirstInput(g_sop)
+        g2_sop.parm("group").set("2")
+        g2_sop.parm("name1").set("interior_g")
+        g2_sop.parm("value1v1").set(0.25)
+        g2_sop.setRenderFlag(True)
+        self.instance.parm("instancepath").set(self.geo1.path())
+        self.instance.parm("ptinstance").set("on")
+        self.compare_scene()
+
     def test_fast_pt_instance(self):
         add_sop = self.instance.createNode("add")
         add_sop.parm("points").set(2)
@@ -504,6 +1055,160 @@ class TestInstance(TestGeo):
         self.instance.parm("ptinstance").set("fast")
         self.compare_scene()
 
+    def test_fast_instance_velocity_blur(self):
+        add_sop = self.instance.createNode("add")
+        add_sop.parm("points").set(2)
+        add_sop.parm("usept0").set(True)
+        add_sop.parm("usept1").set(True)
+        add_sop.parmTuple("pt1").set([2, 0, 0])
+        # Over the 1/48s shutter point 0 moves 0.5 along x and point 1
+        # rotates 90 degrees around z about its position. The orient stops
+        # v from also orienting the instances.
+        wrangle_sop = self.instance.createNode("attribwrangle")
+        wrangle_sop.setFirstInput(add_sop)
+        wrangle_sop.parm("snippet").set(
+            "p@orient = {0, 0, 0, 1};\n"
+            "if (@ptnum == 0) v@v = set(24, 0, 0);\n"
+            "if (@ptnum == 1) v@w = set(0, 0, 24 * PI);\n"
+        )
+        wrangle_sop.setRenderFlag(True)
+        self.instance.parm("instancepath").set(self.geo1.path())
+        self.instance.parm("ptinstance").set("fast")
+        ptg = self.instance.parmTemplateGroup()
+        parm = hou.properties.parmTemplate("pbrt-v3", "pbrt_velocityblur")
+        ptg.append(parm)
+        self.instance.setParmTemplateGroup(ptg)
+        self.instance.parm("pbrt_velocityblur").set(True)
+        self.rop.parm("allowmotionblur").set(True)
+        self.compare_scene()
+
+    def test_nested_fast_instance(self):
+        inner = build_instance()
+        self.extras.append(inner)
+        inner_add_sop = inner.createNode("add")
+        inner_add_sop.parm("usept0").set(True)
+        inner_add_sop.parmTuple("pt0").set([1, 0, 0])
+        inner.parm("ty").set(1)
+        inner.parm("instancepath").set(self.geo1.path())
+        inner.parm("ptinstance").set("fast")
+        inner.setDisplayFlag(False)
+        add_sop = self.instance.createNode("add")
+        add_sop.parm("points").set(2)
+        add_sop.parm("usept0").set(True)
+        add_sop.parm("usept1").set(True)
+        add_sop.parmTuple("pt1").set([3, 0, 0])
+        # Each leaf is the inner point, then the inner instancer's transform,
+        # then the outer point.
+        self.instance.parm("instancepath").set(inner.path())
+        self.instance.parm("ptinstance").set("fast")
+        self.compare_scene()
+
+    def test_hybrid_pt_instance(self):
+        matte = hou.node("/mat").createNode(
+            "pbrt_material_matte", run_init_scripts=False
+        )
+        add_sop = self.instance.createNode("add")
+        add_sop.parm("points").set(3)
+        add_sop.parm("usept0").set(True)
+        add_sop.parm("usept1").set(True)
+        add_sop.parm("usept2").set(True)
+        add_sop.parmTuple("pt1").set([2, 0, 0])
+        add_sop.parmTuple("pt2").set([4, 0, 0])
+        shop_sop = self.instance.createNode("attribcreate")
+        shop_sop.setFirstInput(add_sop)
+        shop_sop.parm("name1").set("shop_materialpath")
+        shop_sop.parm("type1").set("index")
+        shop_sop.parm("string1").set(matte.path())
+        # Points 0 and 1 have the same override written in a different order
+        # so share a prototype, point 2 has its own.
+        overrides = (
+            '{"sigma": 10, "Kdr": 0.1, "Kdg": 0.2, "Kdb": 0.3}',
+            '{"Kdb": 0.3, "Kdg": 0.2, "Kdr": 0.1, "sigma": 10}',
+            '{"sigma": 20}',
+        )
+        prev_sop = shop_sop
+        for pt, override in enumerate(overrides):
+            override_sop = self.instance.createNode("attribcreate")
+            override_sop.setFirstInput(prev_sop)
+            override_sop.parm("group").set(str(pt))
+            override_sop.parm("name1").set("material_override")
+            override_sop.parm("type1").set("index")
+            override_sop.parm("string1").set(override)
+            prev_sop = override_sop
+        prev_sop.setRenderFlag(True)
+        self.instance.parm("instancepath").set(self.geo1.path())
+        self.instance.parm("ptinstance").set("fast")
+        ptg = self.instance.parmTemplateGroup()
+        parm = hou.properties.parmTemplate("pbrt-v3", "pbrt_hybridinstancing")
+        ptg.append(parm)
+        self.instance.setParmTemplateGroup(ptg)
+        self.instance.parm("pbrt_hybridinstancing").set(True)
+        self.compare_scene()
+
+    def test_hybrid_pt_instance_source(self):
+        # The instanced object is not displayed, so its prim material and
+        # medium are only output along with the hybrid prototype.
+        matte = hou.node("/mat").createNode(
+            "pbrt_material_matte", run_init_scripts=False
+        )
+        prim_matte = hou.node("/mat").createNode(
+            "pbrt_material_matte", run_init_scripts=False
+        )
+        medium = hou.node("/mat").createNode("pbrt_medium")
+        material_sop = self.geo1.createNode("material")
+        material_sop.setFirstInput(self.geo1.node("sphere1"))
+        material_sop.parm("shop_materialpath1").set(prim_matte.path())
+        material_sop.setRenderFlag(True)
+        ptg = self.geo1.parmTemplateGroup()
+        ptg.append(hou.properties.parmTemplate("pbrt-v3", "pbrt_interior"))
+        self.geo1.setParmTemplateGroup(ptg)
+        self.geo1.parm("pbrt_interior").set(medium.path())
+
+        add_sop = self.instance.createNode("add")
+        add_sop.parm("usept0").set(True)
+        shop_sop = self.instance.createNode("attribcreate")
+        shop_sop.setFirstInput(add_sop)
+        shop_sop.parm("name1").set("shop_materialpath")
+        shop_sop.parm("type1").set("index")
+        shop_sop.parm("string1").set(matte.path())
+        shop_sop.setRenderFlag(True)
+        self.instance.parm("instancepath").set(self.geo1.path())
+        self.instance.parm("ptinstance").set("fast")
+        ptg = self.instance.parmTemplateGroup()
+        parm = hou.properties.parmTemplate("pbrt-v3", "pbrt_hybridinstancing")
+        ptg.append(parm)
+        self.instance.setParmTemplateGroup(ptg)
+        self.instance.parm("pbrt_hybridinstancing").set(True)
+        self.compare_scene()
+
+    def enable_autoinstance(self):
+        ptg = self.rop.parmTemplateGroup()
+        parm = hou.properties.parmTemplate("pbrt-v3", "pbrt_autoinstance")
+        ptg.append(parm)
+        self.rop.setParmTemplateGroup(ptg)
+        self.rop.parm("pbrt_autoinstance").set(True)
+
+    def test_autoinstance(self):
+        self.enable_autoinstance()
+        self.instance.setDisplayFlag(False)
+        self.geo1.setDisplayFlag(True)
+        self.geo2.setDisplayFlag(True)
+        self.geo2.parm("tx").set(2)
+        self.compare_scene()
+
+    def test_autoinstance_materials(self):
+        self.enable_autoinstance()
+        self.instance.setDisplayFlag(False)
+        self.geo1.setDisplayFlag(True)
+        self.geo2.setDisplayFlag(True)
+        self.geo2.parm("tx").set(2)
+        self.geo2.parm("shop_materialpath").set("")
+        self.compare_scene()
+
+    def test_autoinstance_full_pt_instance(self):
+        self.enable_autoinstance()
+        self.test_full_pt_instance()
+
 
 class TestMediums(TestGeo):
     def setUp(self):
@@ -544,10 +1249,14 @@ class TestProperties(TestGeo):
         self.geo = build_geo()
         exr = "%s.exr" % self.name
         self.rop = build_rop(filename=exr, diskfile=self.testfile)
+        self.extras = []
 
     def tearDown(self):
         self.geo.destroy()
         self.rop.destroy()
+        for extra in self.extras:
+            extra.destroy()
+        self.extras[:] = []
         if CLEANUP_FILES:
             os.remove(self.testfile)
 
@@ -563,6 +1272,39 @@ class TestProperties(TestGeo):
         self.geo.parm("pbrt_include").set("test.pbrt")
         self.compare_scene()
 
+    def enable_cull(self):
+        ptg = self.rop.parmTemplateGroup()
+        for name in ("pbrt_cull", "pbrt_cullmargin", "pbrt_cullmaxdistance"):
+            ptg.append(hou.properties.parmTemplate("pbrt-v3", name))
+        self.rop.setParmTemplateGroup(ptg)
+        self.rop.parm("pbrt_cull").set(True)
+
+    def test_cull(self):
+        self.enable_cull()
+        self.rop.parm("pbrt_cullmargin").set(1)
+        self.geo.createNode("sphere")
+        # Behind the camera
+        behind = build_geo()
+        behind.createNode("sphere")
+        behind.parm("tz").set(10)
+        self.extras.append(behind)
+        # Just off screen to the right, but within the margin
+        margin = build_geo()
+        margin.createNode("sphere")
+        margin.parm("tx").set(4.5)
+        self.extras.append(margin)
+        self.compare_scene()
+
+    def test_cull_max_distance(self):
+        self.enable_cull()
+        self.rop.parm("pbrt_cullmaxdistance").set(10)
+        self.geo.createNode("sphere")
+        far = build_geo()
+        far.createNode("sphere")
+        far.parm("tz").set(-20)
+        self.extras.append(far)
+        self.compare_scene()
+
 
 class TestMaterials(TestGeo):
     def setUp(self):
@@ -855,6 +1597,29 @@ class TestShapes(TestGeo):
         self.geo.parm("pbrt_subdlevels").set(1)
         self.compare_scene()
 
+    def test_loopsubdiv_predice_level_0(self):
+        # No subdivision keeps the cage so the result matches test_trianglemesh
+        self.geo.createNode("box")
+        ptg = self.geo.parmTemplateGroup()
+        for name in ("pbrt_rendersubd", "pbrt_subdlevels", "pbrt_predicesubd"):
+            ptg.append(hou.properties.parmTemplate("pbrt-v3", name))
+        self.geo.setParmTemplateGroup(ptg)
+        self.geo.parm("pbrt_rendersubd").set(True)
+        self.geo.parm("pbrt_subdlevels").set(0)
+        self.geo.parm("pbrt_predicesubd").set(True)
+        self.compare_scene()
+
+    def test_packed_repeated(self):
+        sphere = self.geo.createNode("sphere")
+        pack = self.geo.createNode("pack")
+        pack.setFirstInput(sphere)
+        copy = self.geo.createNode("copyxform", "copy1")
+        copy.setFirstInput(pack)
+        copy.parm("ncy").set(3)
+        copy.parm("tx").set(1.5)
+        copy.setRenderFlag(True)
+        self.compare_scene()
+
     def test_nurbs(self):
         box = self.geo.createNode("box")
         box.parm("type").set("nurbs")